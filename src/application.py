@@ -1,9 +1,9 @@
 import logging
-import json
 import os
 
 from simulationview import SimulationView
-from simulation import Simulation
+from simulation import Simulation, SECONDS_PER_DAY
+import savegame
 
 import pyglet
 from pyglet import gl
@@ -16,11 +16,16 @@ class Application:
     '''
 
 
-    def __init__(self, window):
+    def __init__(self, window, autosave_interval=SECONDS_PER_DAY):
         '''
         Constructor
+
+        autosave_interval -- simulated seconds between two autosaves, None or 0 disables the periodic autosave
         '''
         self.frame_no = 0
+        self.saver = savegame.BackgroundSaver()
+        self.autosave_interval = autosave_interval
+        self.next_autosave = None
         self.wm = WindowManager()
         self.view = SimulationView(self.wm)
 
@@ -32,6 +37,13 @@ class Application:
     def update(self, dt):
         self.view.update(dt)
         self.frame_no += 1
+        if self.state == 'simu' and self.autosave_interval:
+            time = self.view.simulation.time
+            if self.next_autosave is None:
+                self.next_autosave = time + self.autosave_interval
+            elif time >= self.next_autosave:
+                self.next_autosave = time + self.autosave_interval
+                self.autosave()
 
     def on_draw(self):
         gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
@@ -51,14 +63,16 @@ class Application:
         Label(self.menu, '[ new empty simulation ]', 10, 100).on_click = self.menu_new
         Label(self.menu, '[ quit program ]', 10, 180).on_click = self.menu_quit
 
-        if os.path.exists(self.autofile()):
-            Label(self.menu, '[ load last game ]', 10, 130).on_click = lambda:self.load_simulation(self.autofile())
+        lastfile = self.last_autofile()
+        if lastfile:
+            Label(self.menu, '[ load last game ]', 10, 130).on_click = lambda:self.load_simulation(lastfile)
 
     def new_empty_simulation(self):
         self.menu.close()
         simu = Simulation(16, 16)
         self.view.unload()
         self.view.load(simu)
+        self.next_autosave = None
 
     def start_menu(self):
         # simu = load_background_simulation()
@@ -127,25 +141,41 @@ class Application:
 
     def load_simulation(self, filename):
         self.view.unload()
-        with open(filename, 'rt', encoding='utf8') as fp:
-            simulation = Simulation.deserialize(json.load(fp))
+        simulation = savegame.load(filename)
         self.view.load(simulation)
+        self.next_autosave = None
         self.state = 'simu'
 
     def save_simulation(self, filename):
+        '''
+        Save the simulation in the background.
+        Only the snapshot of the simulation state is taken before returning.
+        '''
         if not os.path.isdir(os.path.dirname(filename)):
             os.makedirs(os.path.dirname(filename))
-        with open(filename, 'w', encoding='ascii') as fp:
-            json.dump(self.view.simulation.serialize(), fp)
-        logging.info('Saved {}'.format(os.path.abspath(filename)))
+        self.saver.save(self.view.simulation, filename)
 
 
     def autofile(self):
-        return os.path.expanduser('~/.openpark/autosave.json')
+        return os.path.expanduser('~/.openpark/autosave.opk')
+
+    def last_autofile(self):
+        '''
+        The autosave to offer for loading, None if there is none.
+        Older versions wrote autosave.json, it is used if there is no newer autosave.
+        '''
+        for filename in (self.autofile(), os.path.expanduser('~/.openpark/autosave.json')):
+            if os.path.exists(filename):
+                return filename
+        return None
 
     def autosave(self):
         if self.state == 'simu':
             self.save_simulation(self.autofile())
 
+    def close(self):
+        ''' finish writing pending save games '''
+        self.saver.close()
+
 
 
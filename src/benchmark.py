@@ -0,0 +1,115 @@
+'''
+Throughput benchmarks for the headless simulation.
+
+Every scenario builds a park with a regular grid of paths, fills it with
+guests and reports
+ * the time needed to build the path network,
+ * the time for removing and re-adding a number of path tiles,
+ * ticks per second and nanoseconds per guest-tick of Simulation.update.
+
+usage: python benchmark.py [--all] [--size N] [--guests N] [--density NAME] [--ticks N]
+
+@author: leonhard
+'''
+import argparse
+import itertools
+import random
+import time
+
+import headless
+from simulation import Simulation, Person
+
+SIZES = [16, 64, 128, 256, 512]
+GUESTS = [10, 100, 1000, 10000, 100000]
+
+# distance between two parallel paths of the grid
+DENSITIES = {'dense': 2, 'medium': 4, 'sparse': 8}
+
+# (map size, guests, density) of the default run
+SCENARIOS = [(16, 10, 'dense'),
+             (16, 1000, 'dense'),
+             (64, 1000, 'medium'),
+             (128, 10000, 'medium'),
+             (256, 10000, 'sparse'),
+             (256, 100000, 'dense'),
+             (512, 100000, 'medium')]
+
+EDITS = 100
+
+def build_park(size, density, seed=0):
+    '''
+    Create a size x size park with a grid of paths.
+
+    Paths are laid on every column and row that is a multiple of the grid
+    spacing, shifted such that the park entrance is connected to the grid.
+    Returns the simulation and the list of path tiles.
+    '''
+    random.seed(seed)
+    simulation = Simulation(size, size)
+    spacing = DENSITIES[density]
+    entrance_column = simulation.map_entrance[0] % spacing
+    tiles = [(x, y) for x in range(size) for y in range(size)
+             if x % spacing == entrance_column or y % spacing == 0]
+    for x, y in tiles:
+        simulation.set_path(x, y, True)
+    return simulation, tiles
+
+def add_guests(simulation, tiles, count):
+    ''' place count walking guests on random path tiles '''
+    for i in range(count):
+        x, y = random.choice(tiles)
+        pers = Person(simulation, 'Bench %d' % i,
+                      x + random.uniform(0.2, 0.8), y + random.uniform(0.2, 0.8),
+                      simulation.time, random.randrange(32))
+        pers.action = 'walk'
+
+def edit_paths(simulation, tiles, count):
+    ''' remove and re-add count random path tiles, returns the elapsed seconds '''
+    edited = random.sample(tiles, min(count, len(tiles)))
+    start = time.perf_counter()
+    for x, y in edited:
+        simulation.set_path(x, y, False)
+    for x, y in edited:
+        simulation.set_path(x, y, True)
+    return time.perf_counter() - start
+
+def run_scenario(size, guests, density, ticks):
+    start = time.perf_counter()
+    simulation, tiles = build_park(size, density)
+    build = time.perf_counter() - start
+    edit = edit_paths(simulation, tiles, EDITS)
+    add_guests(simulation, tiles, guests)
+    headless.run(simulation, 10)  # warm up, all guests choose a waypoint
+    elapsed = headless.run(simulation, ticks)
+    return {'size': size,
+            'guests': guests,
+            'density': density,
+            'paths': len(tiles),
+            'build_s': build,
+            'edit_ms': edit * 1000 / (2 * min(EDITS, len(tiles))),
+            'ticks_per_s': ticks / elapsed,
+            'ns_per_guest_tick': elapsed * 1e9 / (ticks * guests)}
+
+HEADER = '{:>9} {:>7} {:>7} {:>7} {:>8} {:>8} {:>10} {:>10}'
+ROW = '{size:>4}x{size:<4} {guests:>7} {density:>7} {paths:>7} {build_s:>8.2f} {edit_ms:>8.3f} {ticks_per_s:>10.1f} {ns_per_guest_tick:>10.1f}'
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the OpenPark simulation.')
+    parser.add_argument('--all', action='store_true', help='run every combination of size, guests and density')
+    parser.add_argument('--size', type=int, action='append', help='only run scenarios with this map size')
+    parser.add_argument('--guests', type=int, action='append', help='only run scenarios with this number of guests')
+    parser.add_argument('--density', choices=sorted(DENSITIES), action='append', help='only run scenarios with this path density')
+    parser.add_argument('--ticks', type=int, default=100, help='number of timed ticks per scenario')
+    args = parser.parse_args()
+
+    if args.all or args.size or args.guests or args.density:
+        scenarios = itertools.product(args.size or SIZES, args.guests or GUESTS, args.density or DENSITIES)
+    else:
+        scenarios = SCENARIOS
+
+    print(HEADER.format('map', 'guests', 'density', 'paths', 'build s', 'edit ms', 'ticks/s', 'ns/g-tick'))
+    for size, guests, density in scenarios:
+        print(ROW.format(**run_scenario(size, guests, density, args.ticks)), flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Fixed timestep clock driving a simulation from the variable frame times.
+
+@author: leonhard
+'''
+
+import time
+
+STEP = 0.01  # simulated seconds per simulation step
+MAX_SUBSTEPS = 64  # simulation steps per frame at most
+
+class FixedStepClock:
+    '''
+    Advances a simulation in steps of a fixed number of simulated seconds.
+
+    The simulated time requested by advance() is accumulated and as many whole
+    steps as fit are simulated, the rest is kept for the next frame. If more
+    than max_substeps steps would be needed in one frame, the excess time is
+    dropped, so a slow frame makes the simulation fall behind instead of
+    making the next frame even slower.
+
+    The renderer draws the state at render_time, which lies between the last
+    two simulated steps according to the time accumulated since the last step.
+
+    In turbo mode the simulation is not tied to the frame time, instead
+    run_for() simulates as many steps as fit into a wall clock budget.
+    '''
+    def __init__(self, simulation, step=STEP, max_substeps=MAX_SUBSTEPS):
+        self.simulation = simulation
+        self.step = step
+        self.max_substeps = max_substeps
+        self.accumulator = 0.0
+        self.dropped = 0.0  # simulated seconds skipped because of the substep cap
+        self.turbo = False
+
+    def advance(self, sim_seconds):
+        ''' accumulate sim_seconds of simulated time and simulate the whole steps, returns the number of steps '''
+        self.accumulator += sim_seconds
+        steps = int(self.accumulator / self.step)
+        if steps > self.max_substeps:
+            self.dropped += (steps - self.max_substeps) * self.step
+            self.accumulator -= (steps - self.max_substeps) * self.step
+            steps = self.max_substeps
+        for _ in range(steps):
+            self.simulation.update(self.step)
+        self.accumulator -= steps * self.step
+        return steps
+
+    def run_for(self, seconds):
+        ''' simulate whole steps until seconds of wall clock time are spent, returns the number of steps '''
+        deadline = time.perf_counter() + seconds
+        steps = 0
+        while True:
+            self.simulation.update(self.step)
+            steps += 1
+            if time.perf_counter() >= deadline:
+                return steps
+
+    @property
+    def alpha(self):
+        ''' the fraction of the next step which has already passed, between 0 and 1 '''
+        return min(self.accumulator / self.step, 1.0)
+
+    @property
+    def render_time(self):
+        ''' the simulated time to draw, interpolated between the last two steps '''
+        return max(self.simulation.time - (1.0 - self.alpha) * self.step, 0.0)
+
+
+def test():
+    def assert_eq(a, b):
+        assert a == b, '%s != %s' % (a, b)
+
+    class Simulation:
+        ''' records the steps it is updated with '''
+        def __init__(self):
+            self.time = 0.0
+            self.steps = []
+
+        def update(self, dt):
+            self.time += dt
+            self.steps.append(dt)
+
+    simulation = Simulation()
+    clock = FixedStepClock(simulation, step=0.25, max_substeps=4)
+    assert_eq(clock.render_time, 0.0)
+
+    # only whole steps are simulated, the rest is kept for the next frame
+    assert_eq(clock.advance(0.625), 2)
+    assert_eq(simulation.time, 0.5)
+    assert_eq(clock.alpha, 0.5)
+    assert_eq(clock.render_time, 0.375)
+    assert_eq(clock.advance(0.125), 1)
+    assert_eq(clock.alpha, 0.0)
+    assert_eq(clock.render_time, 0.5)
+
+    # at most max_substeps steps per frame, the excess time is dropped
+    assert_eq(clock.advance(2.125), 4)
+    assert_eq(simulation.time, 1.75)
+    assert_eq(clock.dropped, 1.0)
+    assert_eq(clock.alpha, 0.5)
+    assert_eq(set(simulation.steps), {0.25})
+
+    # run_for simulates whole steps, at least one
+    assert_eq(clock.run_for(0.0), 1)
+    assert_eq(simulation.time, 2.0)
+
+
+if __name__ == '__main__':
+    test()
@@ -1,3 +1,4 @@
+import collections
 import ctypes
 import logging
 from ctypes import byref, POINTER, pointer, sizeof
@@ -26,42 +27,213 @@ def shader(stype, src):
         raise Exception('Compiling of the shader failed.')
     return handle
 
+# glUniform function for the GLSL types of the uniforms
+UNIFORM_SETTERS = {gl.GL_FLOAT: gl.glUniform1f,
+                   gl.GL_FLOAT_VEC2: gl.glUniform2f,
+                   gl.GL_FLOAT_VEC3: gl.glUniform3f,
+                   gl.GL_FLOAT_VEC4: gl.glUniform4f,
+                   gl.GL_INT: gl.glUniform1i,
+                   gl.GL_INT_VEC2: gl.glUniform2i,
+                   gl.GL_BOOL: gl.glUniform1i,
+                   gl.GL_SAMPLER_2D: gl.glUniform1i,
+                   gl.GL_INT_SAMPLER_2D: gl.glUniform1i,
+                   gl.GL_UNSIGNED_INT_SAMPLER_2D: gl.glUniform1i}
+
 class GlProgram:
+    '''
+    A linked shader program.
+
+    The locations and types of the active uniforms and attributes are looked
+    up once after linking. The program is only bound with glUseProgram if it
+    is not the current program already and uniform values are only uploaded
+    if they differ from the last value set through this object.
+    '''
+    current = None  # the program in use
+
     def __init__(self, vertex_shader, fragment_shader):
         self.handle = gl.glCreateProgram()
         gl.glAttachShader(self.handle, shader(gl.GL_VERTEX_SHADER, vertex_shader))
         gl.glAttachShader(self.handle, shader(gl.GL_FRAGMENT_SHADER, fragment_shader))
         gl.glLinkProgram(self.handle)
+        self.uniforms = self.active(gl.GL_ACTIVE_UNIFORMS, gl.GL_ACTIVE_UNIFORM_MAX_LENGTH,
+                                    gl.glGetActiveUniform, gl.glGetUniformLocation)
+        self.attributes = self.active(gl.GL_ACTIVE_ATTRIBUTES, gl.GL_ACTIVE_ATTRIBUTE_MAX_LENGTH,
+                                      gl.glGetActiveAttrib, gl.glGetAttribLocation)
+        self.values = {}  # uniform name -> the last values uploaded
+        self.missing = set()  # names which were not found, they are only logged once
         self.use()  # early error
 
+    def active(self, count_param, length_param, get_active, get_location):
+        ''' {name: (location, type)} of the active uniforms or attributes '''
+        count = gl.GLint(0)
+        gl.glGetProgramiv(self.handle, count_param, pointer(count))
+        max_length = gl.GLint(0)
+        gl.glGetProgramiv(self.handle, length_param, pointer(max_length))
+        buffer = ctypes.create_string_buffer(max(max_length.value, 1))
+        result = {}
+        for index in range(count.value):
+            length = gl.GLsizei(0)
+            size = gl.GLint(0)
+            gltype = gl.GLenum(0)
+            get_active(self.handle, index, len(buffer), pointer(length), pointer(size), pointer(gltype), buffer)
+            name = buffer.value[:length.value]
+            if name.endswith(b'[0]'):
+                name = name[:-3]
+            result[name] = (get_location(self.handle, buffer), gltype.value)
+        return result
+
     def use(self):
-        gl.glUseProgram(self.handle)
+        if GlProgram.current is not self:
+            gl.glUseProgram(self.handle)
+            GlProgram.current = self
 
-    def vertex_attrib_pointer(self, buffer, name, size, type=gl.GL_FLOAT, normalized=False, stride=0, offset=0):
-        self.use()
-        loc = gl.glGetAttribLocation(self.handle, ctypes.create_string_buffer(name))
+    def _missing(self, kind, name):
+        if name not in self.missing:
+            self.missing.add(name)
+            logging.warning('{} {} is not in the shader.'.format(kind, name))
+
+    def attribute_location(self, name):
+        ''' the location of the attribute name, -1 if it is not active '''
+        location, _ = self.attributes.get(name, (-1, None))
+        return location
+
+    def vertex_attrib_pointer(self, buffer, name, size, type=gl.GL_FLOAT, normalized=False, stride=0, offset=0,
+                              divisor=0, integer=False):
+        '''
+        Source the attribute name from the buffer.
+
+        divisor -- advance the attribute once per divisor instances instead of once per vertex
+        integer -- pass integer data unconverted to an int attribute
+        '''
+        loc = self.attribute_location(name)
         if loc < 0:
-            logging.warning('Attribute {} is not in the shader.'.format(name))
+            self._missing('Attribute', name)
             return
+        self.use()
         gl.glEnableVertexAttribArray(loc)
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, buffer)
-        gl.glVertexAttribPointer(loc, size, type, normalized, stride, ctypes.c_void_p(offset))
+        if integer:
+            gl.glVertexAttribIPointer(loc, size, type, stride, ctypes.c_void_p(offset))
+        else:
+            gl.glVertexAttribPointer(loc, size, type, normalized, stride, ctypes.c_void_p(offset))
+        if divisor:
+            gl.glVertexAttribDivisor(loc, divisor)
 
-    def uniform1i(self, name, value):
-        self.use()
-        loc = gl.glGetUniformLocation(self.handle, ctypes.create_string_buffer(name))
-        if loc < 0:
-            logging.warning('Uniform {} is not in the shader.'.format(name))
+    def set_uniform(self, name, *values):
+        '''
+        Set the uniform name, the glUniform function is chosen by the type
+        of the uniform in the shader. Nothing is uploaded if the values did not change.
+        '''
+        if self.values.get(name) == values:
+            return
+        if name not in self.uniforms:
+            self._missing('Uniform', name)
             return
-        gl.glUniform1i(loc, value);
+        loc, gltype = self.uniforms[name]
+        self.use()
+        UNIFORM_SETTERS[gltype](loc, *values)
+        self.values[name] = values
+
+    def uniform1i(self, name, value):
+        self.set_uniform(name, int(value))
+
+    def uniform1f(self, name, value):
+        self.set_uniform(name, float(value))
 
     def uniform2f(self, name, v0, v1):
-        self.use()
-        loc = gl.glGetUniformLocation(self.handle, ctypes.create_string_buffer(name))
-        if loc < 0:
-            logging.warning('Uniform {} is not in the shader.'.format(name))
-            return
-        gl.glUniform2f(loc, v0, v1);
+        self.set_uniform(name, float(v0), float(v1))
+
+    def uniform3f(self, name, v0, v1, v2):
+        self.set_uniform(name, float(v0), float(v1), float(v2))
+
+
+class VertexArray:
+    '''
+    A vertex array object recording the vertex attribute layout of a draw pass.
+
+    The layout is recorded once by calling GlProgram.vertex_attrib_pointer
+    inside a with block, afterwards bind() restores it with a single call.
+    '''
+    current = None  # the handle of the bound vertex array
+
+    def __init__(self):
+        self.handle = gl.GLuint(0)
+        gl.glGenVertexArrays(1, pointer(self.handle))
+
+    def bind(self):
+        if VertexArray.current != self.handle.value:
+            gl.glBindVertexArray(self.handle)
+            VertexArray.current = self.handle.value
+
+    def __enter__(self):
+        self.bind()
+        return self
+
+    def __exit__(self, *exc_info):
+        gl.glBindVertexArray(0)
+        VertexArray.current = 0
+
+
+class StreamBuffer:
+    '''
+    A vertex buffer for geometry which is rewritten every frame.
+
+    The GL buffer is used as a ring of segments. Each write() goes behind the
+    previous one into a range mapped with GL_MAP_UNSYNCHRONIZED_BIT, so the
+    driver does not wait for draws still reading the earlier ranges. When the
+    ring is full the storage is orphaned and writing starts at the beginning
+    again. With segments=1 every write orphans the storage and starts at
+    offset 0, that is needed for data whose offset is recorded in a vertex array,
+    such as per instance attributes.
+
+    staging() hands out CPU memory which is reused from frame to frame.
+    (Persistently mapped buffers need glBufferStorage, which pyglet does not provide.)
+    '''
+    def __init__(self, size=1 << 16, segments=3):
+        self.handle = gl.GLuint(0)
+        gl.glGenBuffers(1, pointer(self.handle))
+        self.segments = segments
+        self.size = 0
+        self.position = 0
+        self.memory = bytearray()
+        self.allocate(size * segments)
+
+    def allocate(self, size):
+        ''' orphan the storage and allocate size bytes '''
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.handle)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, size, None, gl.GL_STREAM_DRAW)
+        self.size = size
+        self.position = 0
+
+    def staging(self, ctype, count):
+        ''' a ctypes array of count elements of ctype in reused CPU memory, valid until the next call '''
+        nbytes = sizeof(ctype) * count
+        if len(self.memory) < nbytes:
+            self.memory = bytearray(max(nbytes, 2 * len(self.memory)))
+        return (ctype * count).from_buffer(self.memory)
+
+    def write(self, data, alignment=1):
+        '''
+        Copy data (a ctypes or numpy array) into the buffer.
+
+        Returns the offset in units of alignment, e.g. the index of the first
+        vertex if alignment is the size of a vertex.
+        '''
+        nbytes = memoryview(data).nbytes
+        if nbytes * self.segments > self.size:
+            self.allocate(nbytes * self.segments * 2)
+        offset = -(-self.position // alignment) * alignment
+        if self.segments == 1 or offset + nbytes > self.size:
+            self.allocate(self.size)
+            offset = 0
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.handle)
+        if nbytes:
+            flags = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_UNSYNCHRONIZED_BIT | gl.GL_MAP_INVALIDATE_RANGE_BIT
+            address = gl.glMapBufferRange(gl.GL_ARRAY_BUFFER, offset, nbytes, flags)
+            ctypes.memmove(address, (ctypes.c_char * nbytes).from_buffer(data), nbytes)
+            gl.glUnmapBuffer(gl.GL_ARRAY_BUFFER)
+        self.position = offset + nbytes
+        return offset // alignment
 
 
 def make_texture(filename, indexed=False):
@@ -124,6 +296,9 @@ class Framebuffer:
 
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer)
         gl.glBufferData(gl.GL_ARRAY_BUFFER, sizeof(data), data, gl.GL_STATIC_DRAW)
+        self.vertex_array = VertexArray()
+        with self.vertex_array:
+            self.program.vertex_attrib_pointer(self.vertex_buffer, b"position", 4, stride=4 * sizeof(gl.GLfloat))
 
         gl.glGenFramebuffers(1, pointer(self.fbo))
         if not self.fbo:
@@ -182,5 +357,62 @@ class Framebuffer:
         gl.glActiveTexture(gl.GL_TEXTURE0)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.rendered_texture)
         self.program.uniform1i(b"tex", 0)
-        self.program.vertex_attrib_pointer(self.vertex_buffer, b"position", 4, stride=4 * sizeof(gl.GLfloat))
+        self.vertex_array.bind()
         gl.glDrawArrays(gl.GL_QUADS, 0, 4)
+
+class PixelReader:
+    '''
+    Reads the depth and the object id of single pixels of a Framebuffer
+    asynchronously through pixel buffer objects.
+
+    request() starts the transfer without waiting for the GPU, resolve()
+    returns the result latency frames later, when the transfer is finished.
+    '''
+    def __init__(self, latency=2):
+        self.latency = latency
+        self.buffers = (gl.GLuint * (latency + 1))()
+        gl.glGenBuffers(len(self.buffers), self.buffers)
+        for buffer in self.buffers:
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, buffer)
+            gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, 8, None, gl.GL_STREAM_READ)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.next_buffer = 0
+        self.frame = 0
+        self.pending = collections.deque()  # (buffer, frame, tag) of the running transfers
+
+    def request(self, x, y, tag=None):
+        '''
+        Start reading the pixel x, y of the bound framebuffer.
+
+        tag is returned with the result, e.g. the state at the time of the request.
+        '''
+        if len(self.pending) == len(self.buffers):
+            self.pending.popleft()
+        buffer = self.buffers[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, buffer)
+        gl.glReadPixels(x, y, 1, 1, gl.GL_DEPTH_COMPONENT, gl.GL_FLOAT, ctypes.c_void_p(0))
+        gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT1)
+        gl.glReadPixels(x, y, 1, 1, gl.GL_RED_INTEGER, gl.GL_INT, ctypes.c_void_p(4))
+        gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT0)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.pending.append((buffer, self.frame, tag))
+
+    def resolve(self):
+        '''
+        Call once per frame. Returns (depth, object id, tag) of the newest request
+        which is at least latency frames old or None if there is none.
+        '''
+        self.frame += 1
+        ready = None
+        while self.pending and self.frame - self.pending[0][1] >= self.latency:
+            ready = self.pending.popleft()
+        if ready is None:
+            return None
+        buffer, _, tag = ready
+        data = (ctypes.c_byte * 8)()
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, buffer)
+        gl.glGetBufferSubData(gl.GL_PIXEL_PACK_BUFFER, 0, 8, data)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        return ctypes.c_float.from_buffer(data, 0).value, ctypes.c_int.from_buffer(data, 4).value, tag
@@ -0,0 +1,440 @@
+'''
+Structure-of-arrays storage for the guests of a simulation.
+
+The per-guest state is kept in parallel numpy arrays indexed by a slot
+number. simulation.Person objects are thin views onto one slot of the store.
+
+Guests move analytically: x and y hold the position at depart_time, the
+position at a later time is computed from the speed and the waypoint by
+positions(). The simulation only touches a guest when its wake_time is
+reached, see Simulation.update_guests. The TileIndex keeps track of the tile
+every guest is on.
+
+@author: leonhard
+'''
+
+from collections import defaultdict
+import heapq
+from math import copysign, floor, inf, isnan
+
+import numpy as np
+
+ACTION_WAIT = 0
+ACTION_WALK = 1
+ACTIONS = ['wait', 'walk']
+
+POSE_STAND = 0
+POSE_WALK = 1
+POSES = ['stand', 'walk']
+
+WAIT_DURATION = 1.0
+
+# name, dtype and value of unused slots for every per-guest column
+COLUMNS = [('x', np.float64, 0.0),
+           ('y', np.float64, 0.0),
+           ('action', np.int8, ACTION_WAIT),
+           ('action_started', np.float64, 0.0),
+           ('depart_time', np.float64, 0.0),
+           ('wake_time', np.float64, np.inf),
+           ('tile_x', np.int32, 0),
+           ('tile_y', np.int32, 0),
+           ('indexed', np.bool_, False),
+           ('cross_time', np.float64, np.inf),
+           ('next_tile_x', np.int32, 0),
+           ('next_tile_y', np.int32, 0),
+           ('waypoint_x', np.float64, np.nan),
+           ('waypoint_y', np.float64, np.nan),
+           ('last_x', np.int32, 0),
+           ('last_y', np.int32, 0),
+           ('has_last', np.bool_, False),
+           ('direction', np.int16, 0),
+           ('pose', np.int8, POSE_STAND),
+           ('palette', np.int8, 0),
+           ('speed', np.float64, 0.0),
+           ('arrival_time', np.float64, 0.0),
+           ('serial', np.int64, 0),
+           ('alive', np.bool_, False)]
+
+
+class GuestStore:
+    '''
+    Parallel arrays holding the state of all guests.
+
+    Slots of removed guests are recycled, so the slot of a guest is stable
+    for its whole lifetime. The serial number distinguishes the guests which
+    used the same slot. The views list holds the Person object of every
+    occupied slot and None for free slots.
+    '''
+    def __init__(self, capacity=64):
+        self.capacity = 0
+        self.count = 0
+        self.next_serial = 1
+        self.views = []
+        self.free = []
+        for name, dtype, _ in COLUMNS:
+            setattr(self, name, np.zeros(0, dtype))
+        self._grow(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (view for view in self.views if view is not None)
+
+    def _grow(self, capacity):
+        old = self.capacity
+        for name, dtype, default in COLUMNS:
+            column = np.full(capacity, default, dtype)
+            column[:old] = getattr(self, name)
+            setattr(self, name, column)
+        # free slots are taken from the end of the list, lower slots are used first
+        self.free[:0] = range(capacity - 1, old - 1, -1)
+        self.capacity = capacity
+
+    def add(self, view, x, y, t, palette, speed):
+        ''' allocate a slot for a new guest and return the slot number '''
+        if not self.free:
+            self._grow(max(2 * self.capacity, 64))
+        slot = self.free.pop()
+        for name, _, default in COLUMNS:
+            getattr(self, name)[slot] = default
+        self.x[slot] = x
+        self.y[slot] = y
+        self.palette[slot] = palette
+        self.speed[slot] = speed
+        self.arrival_time[slot] = t
+        self.serial[slot] = self.next_serial
+        self.next_serial += 1
+        self.alive[slot] = True
+        self.count += 1
+        if slot < len(self.views):
+            self.views[slot] = view
+        else:
+            self.views.extend([None] * (slot - len(self.views)))
+            self.views.append(view)
+        return slot
+
+    def add_many(self, count, speed):
+        '''
+        Allocate slots for count new guests at once and return the slot numbers.
+
+        The columns of the new guests have their default values, the caller
+        fills them and sets the views.
+        '''
+        while len(self.free) < count:
+            self._grow(max(2 * self.capacity, 64))
+        slots = np.array(self.free[len(self.free) - count:][::-1], np.int64)
+        del self.free[len(self.free) - count:]
+        for name, _, default in COLUMNS:
+            getattr(self, name)[slots] = default
+        self.speed[slots] = speed
+        self.serial[slots] = np.arange(self.next_serial, self.next_serial + count)
+        self.next_serial += count
+        self.alive[slots] = True
+        self.count += count
+        if len(slots) and slots.max() >= len(self.views):
+            self.views.extend([None] * (slots.max() + 1 - len(self.views)))
+        return slots
+
+    def remove(self, slot):
+        ''' free the slot of a guest that left the simulation '''
+        assert self.alive[slot]
+        self.alive[slot] = False
+        self.views[slot] = None
+        self.count -= 1
+        self.free.append(slot)
+
+    def travel_time(self, slots):
+        ''' the time the guests in slots need from x, y to their waypoint, 0 for guests without waypoint '''
+        distance = np.abs(self.waypoint_x[slots] - self.x[slots]) + np.abs(self.waypoint_y[slots] - self.y[slots])
+        return np.nan_to_num(distance) / self.speed[slots]
+
+    def wake_times(self, slots, t):
+        '''
+        The times at which the guests in slots need the attention of the simulation.
+
+        Waiting guests wake up when they have waited long enough, walking guests
+        when they arrive at their waypoint and walking guests without waypoint
+        immediately at t.
+        '''
+        waiting = self.action[slots] == ACTION_WAIT
+        return np.where(waiting, self.action_started[slots] + WAIT_DURATION,
+                        np.maximum(self.depart_time[slots] + self.travel_time(slots), t))
+
+    def wake_at(self, slot, t):
+        ''' the wake time of the guest in slot, the same as wake_times() for a single guest '''
+        if self.action[slot] == ACTION_WAIT:
+            return self.action_started[slot].item() + WAIT_DURATION
+        travel_time = 0.0
+        if not isnan(self.waypoint_x[slot]):
+            distance = abs(self.waypoint_x[slot] - self.x[slot]) + abs(self.waypoint_y[slot] - self.y[slot])
+            travel_time = distance.item() / self.speed[slot].item()
+        return max(self.depart_time[slot].item() + travel_time, t)
+
+    def positions(self, slots, t):
+        '''
+        The x and y coordinates of the guests in slots at time t.
+
+        Guests walk along the x axis first and then along the y axis.
+        '''
+        dx = np.nan_to_num(self.waypoint_x[slots] - self.x[slots])
+        dy = np.nan_to_num(self.waypoint_y[slots] - self.y[slots])
+        walked = self.speed[slots] * np.maximum(t - self.depart_time[slots], 0.0)
+        along_x = np.minimum(walked, np.abs(dx))
+        along_y = np.clip(walked - along_x, 0.0, np.abs(dy))
+        return self.x[slots] + np.sign(dx) * along_x, self.y[slots] + np.sign(dy) * along_y
+
+    def position(self, slot, t):
+        ''' the (x, y) of the guest in slot at time t, the same as positions() for a single guest '''
+        x = self.x[slot].item()
+        y = self.y[slot].item()
+        waypoint_x = self.waypoint_x[slot].item()
+        if isnan(waypoint_x):
+            return x, y
+        dx = waypoint_x - x
+        dy = self.waypoint_y[slot].item() - y
+        walked = self.speed[slot].item() * max(t - self.depart_time[slot].item(), 0.0)
+        along_x = min(walked, abs(dx))
+        along_y = min(max(walked - along_x, 0.0), abs(dy))
+        return x + copysign(along_x, dx), y + copysign(along_y, dy)
+
+    def settle(self, slots, t):
+        ''' store the positions at time t in x and y, the guests depart from there at t '''
+        self.x[slots], self.y[slots] = self.positions(slots, t)
+        self.depart_time[slots] = t
+
+    def update_poses(self, t):
+        ''' set pose and direction of all guests from their action and movement at time t '''
+        slots = np.flatnonzero(self.alive)
+        x, y = self.positions(slots, t)
+        dx = np.nan_to_num(self.waypoint_x[slots] - x)
+        dy = np.nan_to_num(self.waypoint_y[slots] - y)
+        moving = (self.action[slots] == ACTION_WALK) & ((dx != 0) | (dy != 0))
+        self.pose[slots] = np.where(moving, POSE_WALK, POSE_STAND)
+
+        direction = np.select([dx < 0, dx > 0, dy < 0, dy > 0], [180, 0, 270, 90])
+        self.direction[slots[moving]] = direction[moving]
+
+
+class TileIndex:
+    '''
+    The guests on every tile, kept up to date while the guests walk.
+
+    The tile of a guest is stored in the tile_x and tile_y columns of the
+    GuestStore. Guests walk straight lines between waypoints, so the time at
+    which a guest crosses into the next tile is known in advance. The
+    crossings are kept in a heap like the guest events and a guest only moves
+    in the index when a crossing comes up or its movement changes.
+
+    The index holds the tiles at the simulation time, the last time passed to
+    update() or advance().
+    '''
+    def __init__(self, store, width, height):
+        self.store = store
+        self.tiles = defaultdict(set)  # the slots of the guests on every occupied (column, row)
+        self.occupancy = np.zeros((width, height), np.int32)  # the number of guests on every tile of the map
+        self.crossings = []  # heap of the (time, guest serial, slot) at which guests cross into the next tile
+
+    def _move(self, slot, column, row):
+        store = self.store
+        if store.indexed[slot]:
+            self._discard(slot)
+        store.tile_x[slot] = column
+        store.tile_y[slot] = row
+        store.indexed[slot] = True
+        self.tiles[column, row].add(slot)
+        if 0 <= column < self.occupancy.shape[0] and 0 <= row < self.occupancy.shape[1]:
+            self.occupancy[column, row] += 1
+
+    def _discard(self, slot):
+        store = self.store
+        column, row = store.tile_x[slot].item(), store.tile_y[slot].item()
+        slots = self.tiles[column, row]
+        slots.discard(slot)
+        if not slots:
+            del self.tiles[column, row]
+        if 0 <= column < self.occupancy.shape[0] and 0 <= row < self.occupancy.shape[1]:
+            self.occupancy[column, row] -= 1
+
+    def _next_crossing(self, slot, t, x, y, column, row):
+        '''
+        The time at which the guest in slot, at x, y on the tile column, row
+        at time t, leaves the tile and the (column, row) it enters, (inf, None)
+        if it stays.
+        '''
+        store = self.store
+        waypoint_x = store.waypoint_x[slot].item()
+        if isnan(waypoint_x):
+            return inf, None
+        waypoint_y = store.waypoint_y[slot].item()
+        speed = store.speed[slot].item()
+        # the x leg of the walk comes first
+        if x != waypoint_x:
+            if waypoint_x > x and waypoint_x >= column + 1:
+                return t + (column + 1 - x) / speed, (column + 1, row)
+            if waypoint_x < x and waypoint_x < column:
+                return t + (x - column) / speed, (column - 1, row)
+            t += abs(waypoint_x - x) / speed
+        if waypoint_y > y and waypoint_y >= row + 1:
+            return t + (row + 1 - y) / speed, (column, row + 1)
+        if waypoint_y < y and waypoint_y < row:
+            return t + (y - row) / speed, (column, row - 1)
+        return inf, None
+
+    def _schedule_crossing(self, slot, t, x, y, column, row):
+        store = self.store
+        cross_time, tile = self._next_crossing(slot, t, x, y, column, row)
+        store.cross_time[slot] = cross_time
+        if tile is not None:
+            store.next_tile_x[slot], store.next_tile_y[slot] = tile
+            heapq.heappush(self.crossings, (cross_time, store.serial[slot].item(), slot))
+
+    def update(self, slot, t):
+        ''' put the guest in slot on its tile at time t and plan its next crossing, after any change of its movement '''
+        store = self.store
+        x, y = store.position(slot, t)
+        column, row = floor(x), floor(y)
+        if not store.indexed[slot] or store.tile_x[slot] != column or store.tile_y[slot] != row:
+            self._move(slot, column, row)
+        self._schedule_crossing(slot, t, x, y, column, row)
+
+    def remove(self, slot):
+        ''' remove the guest in slot, before the slot is freed '''
+        if self.store.indexed[slot]:
+            self._discard(slot)
+            self.store.indexed[slot] = False
+        self.store.cross_time[slot] = inf
+
+    def advance(self, t):
+        ''' move the guests which cross into another tile up to time t '''
+        store = self.store
+        crossings = self.crossings
+        while crossings and crossings[0][0] <= t:
+            cross_time, serial, slot = heapq.heappop(crossings)
+            if not store.alive[slot] or store.serial[slot] != serial or store.cross_time[slot] != cross_time:
+                continue  # the guest left or changed its way
+            column, row = store.next_tile_x[slot].item(), store.next_tile_y[slot].item()
+            # the guest is on the edge between the tiles, on the x leg or the y leg of its walk
+            if column != store.tile_x[slot]:
+                x, y = max(column, store.tile_x[slot].item()), store.y[slot].item()
+            else:
+                x, y = store.waypoint_x[slot].item(), max(row, store.tile_y[slot].item())
+            self._move(slot, column, row)
+            self._schedule_crossing(slot, cross_time, x, y, column, row)
+
+    def at(self, column, row):
+        ''' the set of the slots of the guests on a tile, it must not be modified '''
+        return self.tiles.get((column, row), frozenset())
+
+    def count(self, column, row):
+        ''' the number of guests on a tile '''
+        return len(self.tiles.get((column, row), ()))
+
+    def in_rect(self, column0, row0, column1, row1):
+        ''' array of the slots of the guests on the tiles from column0, row0 to column1, row1 inclusive '''
+        if (column1 - column0 + 1) * (row1 - row0 + 1) > len(self.tiles):
+            tiles = [slots for (column, row), slots in self.tiles.items()
+                     if column0 <= column <= column1 and row0 <= row <= row1]
+        else:
+            tiles = [self.tiles[column, row] for column in range(column0, column1 + 1)
+                     for row in range(row0, row1 + 1) if (column, row) in self.tiles]
+        return np.fromiter((slot for slots in tiles for slot in slots), np.int64)
+
+    def near(self, x, y, radius, t):
+        ''' array of the slots of the guests at most radius away from x, y at time t '''
+        slots = self.in_rect(floor(x - radius), floor(y - radius), floor(x + radius), floor(y + radius))
+        guest_x, guest_y = self.store.positions(slots, t)
+        return slots[(guest_x - x) ** 2 + (guest_y - y) ** 2 <= radius * radius]
+
+def test():
+    def assert_eq(a, b):
+        assert a == b, '%s != %s' % (a, b)
+
+    store = GuestStore(capacity=2)
+    views = ['A', 'B', 'C']
+    slots = [store.add(view, x, 0.5, 0.0, x, 1.0) for x, view in enumerate(views)]
+
+    # the store grows beyond its capacity and keeps the columns of the guests
+    assert_eq(sorted(slots), [0, 1, 2])
+    assert store.capacity >= 3
+    assert_eq(len(store), 3)
+    assert_eq(list(store), views)
+    assert_eq(store.x[slots].tolist(), [0.0, 1.0, 2.0])
+    assert_eq(store.palette[slots].tolist(), [0, 1, 2])
+
+    # removing frees the slot, the next guest reuses it with default columns
+    store.action[slots[1]] = ACTION_WALK
+    store.waypoint_x[slots[1]] = 3.0
+    store.remove(slots[1])
+    assert_eq(len(store), 2)
+    assert_eq(list(store), ['A', 'C'])
+    assert not store.alive[slots[1]]
+    slot = store.add('D', 4.0, 4.5, 2.0, 7, 1.0)
+    assert_eq(slot, slots[1])
+    assert_eq(len(store), 3)
+    assert_eq(store.views[slot], 'D')
+    assert_eq(store.action[slot], ACTION_WAIT)
+    assert np.isnan(store.waypoint_x[slot])
+    assert_eq((store.x[slot], store.y[slot], store.arrival_time[slot]), (4.0, 4.5, 2.0))
+
+    # a walking guest goes along x first and wakes up on arrival, a waiting guest after WAIT_DURATION
+    store.action[slot] = ACTION_WALK
+    store.waypoint_x[slot], store.waypoint_y[slot] = 2.0, 5.5
+    store.depart_time[slot] = 2.0
+    store.action_started[slots[0]] = 1.0
+    x, y = store.positions(np.array([slot, slots[0]]), 3.5)
+    assert_eq((x.tolist(), y.tolist()), ([2.5, 0.0], [4.5, 0.5]))
+    x, y = store.positions(np.array([slot, slot]), np.array([4.5, 6.0]))
+    assert_eq((x.tolist(), y.tolist()), ([2.0, 2.0], [5.0, 5.5]))
+    assert_eq(store.wake_times(np.array([slot, slots[0]]), 0.0).tolist(), [5.0, 1.0 + WAIT_DURATION])
+
+    # the scalar versions for single guests agree
+    assert_eq(store.position(slot, 3.5), (2.5, 4.5))
+    assert_eq(store.position(slots[0], 3.5), (0.0, 0.5))
+    assert_eq((store.wake_at(slot, 0.0), store.wake_at(slots[0], 0.0)), (5.0, 1.0 + WAIT_DURATION))
+
+    # the tile index agrees with the positions while guests walk, change their way and leave
+    import random
+    rnd = random.Random(1)
+    store = GuestStore()
+    index = TileIndex(store, 8, 8)
+
+    def walk(slot, t):
+        store.settle(slot, t)
+        store.action[slot] = ACTION_WALK
+        store.waypoint_x[slot], store.waypoint_y[slot] = rnd.uniform(0, 8), rnd.uniform(0, 8)
+        index.update(slot, t)
+
+    def check(t):
+        slots = np.flatnonzero(store.alive)
+        x, y = store.positions(slots, t)
+        expected = defaultdict(set)
+        for slot, column, row in zip(slots.tolist(), np.floor(x).astype(int).tolist(), np.floor(y).astype(int).tolist()):
+            expected[column, row].add(slot)
+        assert_eq(dict(index.tiles), dict(expected))
+        assert_eq(index.occupancy.sum(), len(store))
+        for (column, row), tile in expected.items():
+            assert_eq(index.count(column, row), len(tile))
+        assert_eq(sorted(index.in_rect(2, 2, 5, 5).tolist()),
+                  sorted(slot for (column, row), tile in expected.items()
+                         if 2 <= column <= 5 and 2 <= row <= 5 for slot in tile))
+
+    t = 0.0
+    for _ in range(20):
+        slot = store.add(None, rnd.uniform(0, 8), rnd.uniform(0, 8), t, 0, rnd.uniform(0.5, 2.0))
+        walk(slot, t)
+    for _ in range(200):
+        t += rnd.uniform(0.0, 0.3)
+        index.advance(t)
+        check(t)
+        slot = rnd.choice(np.flatnonzero(store.alive).tolist())
+        if rnd.random() < 0.1:
+            index.remove(slot)
+            store.remove(slot)
+            slot = store.add(None, rnd.uniform(0, 8), rnd.uniform(0, 8), t, 0, 1.0)
+        walk(slot, t)
+        check(t)
+
+
+if __name__ == '__main__':
+    test()
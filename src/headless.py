@@ -0,0 +1,50 @@
+'''
+Run a simulation without a window or an OpenGL context.
+
+usage: python headless.py [--load FILE] [--save FILE] [--ticks N] [--dt SECONDS]
+
+The save game format is chosen by the file extension, see savegame.
+
+@author: leonhard
+'''
+import argparse
+import logging, logging.config
+import time
+
+from clock import STEP
+from simulation import Simulation
+import savegame
+
+def run(simulation, ticks, dt=STEP):
+    '''
+    Advance the simulation by the given number of ticks of dt simulated seconds.
+
+    Returns the wall clock time in seconds spent inside Simulation.update.
+    '''
+    start = time.perf_counter()
+    for _ in range(ticks):
+        simulation.update(dt)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Run an OpenPark simulation without graphics.')
+    parser.add_argument('--load', help='saved game to start from, default is a new 16x16 park')
+    parser.add_argument('--save', help='file to save the simulation to after the run')
+    parser.add_argument('--ticks', type=int, default=10000, help='number of ticks to simulate')
+    parser.add_argument('--dt', type=float, default=STEP, help='simulated seconds per tick')
+    args = parser.parse_args()
+
+    logging.config.fileConfig('logging.conf')
+    if args.load:
+        simulation = savegame.load(args.load)
+    else:
+        simulation = Simulation(16, 16)
+    elapsed = run(simulation, args.ticks, args.dt)
+    logging.info('Simulated {} ticks in {:0.3f}s ({:0.0f} ticks/s), {} guests in the park'.format(
+        args.ticks, elapsed, args.ticks / elapsed, len(simulation.guests)))
+    if args.save:
+        savegame.save(simulation, args.save)
+        logging.info('Saved {}'.format(args.save))
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import argparse
 import sys
 import logging, logging.config
 
@@ -6,6 +7,7 @@ from pyglet import gl
 from pyglet.window import key
 
 import application
+from simulation import SECONDS_PER_DAY
 
 window = pyglet.window.Window(resizable=True)
 
@@ -14,16 +16,22 @@ def initialize_gl():
     gl.glClearColor(0.5, 0.5, 0.35, 1)
 
 def main():
+    parser = argparse.ArgumentParser(description='OpenPark')
+    parser.add_argument('--autosave-interval', type=float, default=SECONDS_PER_DAY,
+                        help='simulated seconds between two autosaves, 0 disables the periodic autosave')
+    args = parser.parse_args()
+
     logging.config.fileConfig('logging.conf')
     try:
         initialize_gl()
-        app = application.Application(window)
+        app = application.Application(window, autosave_interval=args.autosave_interval)
         window.push_handlers(app)
 
         pyglet.clock.schedule_interval(app.update, 0.01)
         pyglet.app.run()
 
         app.autosave()
+        app.close()
     except:
         logging.exception('Uncaught Exception')
         sys.exit(1)
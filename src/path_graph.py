@@ -15,150 +15,566 @@ MASK_YD = 8
 
 OPP_MASK = {MASK_XU: MASK_XD, MASK_XD: MASK_XU,
             MASK_YU: MASK_YD, MASK_YD: MASK_YU}
-
-from collections import defaultdict
+# neighbour slot of a node for each connection direction, slot i belongs to bit i
+SLOT = {MASK_XU: 0, MASK_YU: 1, MASK_XD: 2, MASK_YD: 3}
+OPP_SLOT = [2, 3, 0, 1]
+
+import collections.abc
+import contextlib
+import numpy as np
+
+EDGE_V = 0
+EDGE_H = 1
+EDGE_OFFSET = 1 << 15
+EDGE_SPAN = 1 << 16
+
+def edge_key(orientation, x, y, z):
+    ''' pack a grid edge into an integer usable as dictionary key '''
+    return (((x + EDGE_OFFSET) * EDGE_SPAN + y + EDGE_OFFSET) * EDGE_SPAN + z + EDGE_OFFSET) * 2 + orientation
+
+def attachment_points(pos, ptype):
+    ''' the attachment points (grid edges) of a path element as a list of (edge_key, mask) '''
+    x, y, z = pos
+
+    if ptype == TYPE_FLAT:
+        return [(edge_key(EDGE_V, x, y, z), MASK_XD), (edge_key(EDGE_V, x + 1, y, z), MASK_XU),
+                (edge_key(EDGE_H, x, y, z), MASK_YD), (edge_key(EDGE_H, x, y + 1, z), MASK_YU)]
+    elif ptype == TYPE_UP_X:
+        return [(edge_key(EDGE_V, x, y, z), MASK_XD), (edge_key(EDGE_V, x + 1, y, z + 1), MASK_XU)]
+    elif ptype == TYPE_UP_Y:
+        return [(edge_key(EDGE_H, x, y, z), MASK_YD), (edge_key(EDGE_H, x, y + 1, z + 1), MASK_YU)]
+    elif ptype == TYPE_DN_X:
+        return [(edge_key(EDGE_V, x, y, z + 1), MASK_XD), (edge_key(EDGE_V, x + 1, y, z), MASK_XU)]
+    elif ptype == TYPE_DN_Y:
+        return [(edge_key(EDGE_H, x, y, z + 1), MASK_YD), (edge_key(EDGE_H, x, y + 1, z), MASK_YU)]
+    elif ptype == TYPE_POI_XD:
+        return [(edge_key(EDGE_V, x, y, z), MASK_XD)]
+    elif ptype == TYPE_POI_XU:
+        return [(edge_key(EDGE_V, x + 1, y, z), MASK_XU)]
+    elif ptype == TYPE_POI_YD:
+        return [(edge_key(EDGE_H, x, y, z), MASK_YD)]
+    elif ptype == TYPE_POI_YU:
+        return [(edge_key(EDGE_H, x, y + 1, z), MASK_YU)]
+    else:
+        assert False, 'illegal ptype %r' % ptype
 
 class PathElement:
-    def __init__(self, pos, ptype):
-        self.pos = pos
-        self.ptype = ptype
-        self.neighbours = []
-        self.connection_bitfield = 0
+    '''
+    View onto the node of a PathGraph.
+
+    The data of the node is held in the arrays of the graph, views are created on demand.
+    '''
+    __slots__ = ('graph', 'id')
+
+    def __init__(self, graph, node):
+        self.graph = graph
+        self.id = node
 
     def __repr__(self):
         return str(self.pos)
 
+    def __eq__(self, other):
+        return isinstance(other, PathElement) and self.graph is other.graph and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def pos(self):
+        return tuple(self.graph.position[self.id].tolist())
+
+    @property
+    def ptype(self):
+        return int(self.graph.ptype[self.id])
+
+    @property
+    def connection_bitfield(self):
+        return int(self.graph.connection_bitfield[self.id])
+
+    @property
+    def neighbours(self):
+        return [PathElement(self.graph, nb) for nb in self.graph.neighbour[self.id].tolist() if nb >= 0]
+
     def attachment_points(self):
-        x, y, z = self.pos
-
-        # attach is a list of attachment points (grid edges) of the new path element
-        if self.ptype == TYPE_FLAT:
-            return [(('V', x, y, z), MASK_XD), (('V', x + 1, y, z), MASK_XU), (('H', x, y, z), MASK_YD), (('H', x, y + 1, z), MASK_YU)]
-        elif self.ptype == TYPE_UP_X:
-            return [(('V', x, y, z), MASK_XD), (('V', x + 1, y, z + 1), MASK_XU)]
-        elif self.ptype == TYPE_UP_Y:
-            return [(('H', x, y, z), MASK_YD), (('H', x, y + 1, z + 1), MASK_YU)]
-        elif self.ptype == TYPE_DN_X:
-            return [(('V', x, y, z + 1), MASK_XD), (('V', x + 1, y, z), MASK_XU)]
-        elif self.ptype == TYPE_DN_Y:
-            return [(('H', x, y, z + 1), MASK_YD), (('H', x, y + 1, z), MASK_YU)]
-        elif self.ptype == TYPE_POI_XD:
-            return [(('V', x, y, z), MASK_XD)]
-        elif self.ptype == TYPE_POI_XU:
-            return [(('V', x + 1, y, z), MASK_XU)]
-        elif self.ptype == TYPE_POI_YD:
-            return [(('H', x, y, z), MASK_YD)]
-        elif self.ptype == TYPE_POI_YU:
-            return [(('H', x, y + 1, z), MASK_YU)]
+        return attachment_points(self.pos, self.ptype)
+
+class PathView(collections.abc.Mapping):
+    ''' read only mapping from position to PathElement '''
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, pos):
+        return PathElement(self.graph, self.graph.node_ids[pos])
+
+    def __contains__(self, pos):
+        return pos in self.graph.node_ids
+
+    def __iter__(self):
+        return iter(self.graph.node_ids)
+
+    def __len__(self):
+        return len(self.graph.node_ids)
+
+UNREACHABLE = np.iinfo(np.int32).max
+
+# a removal invalidating more than 1 / REBUILD_FRACTION of the nodes rebuilds the whole field
+REBUILD_FRACTION = 8
+
+class FlowField:
+    '''
+    Distances to the nearest of a set of source nodes with the direction to go there.
+
+    The arrays are indexed by node id:
+     * distance -- number of steps to the nearest source, -1 if no source can be reached
+     * next_hop -- neighbour slot (see SLOT) of the next step towards the nearest source,
+       -1 at the sources and at unreachable nodes
+
+    Distances are stored as int16, paths longer than 32767 steps are not supported.
+    The field is repaired incrementally when the graph changes.
+    '''
+    def __init__(self, graph, sources=()):
+        self.graph = graph
+        self.sources = set(sources)
+        self.distance = np.full(graph.capacity, -1, np.int16)
+        self.next_hop = np.full(graph.capacity, -1, np.int8)
+        if not graph.in_bulk:
+            self.rebuild()
+
+    def grow(self, capacity):
+        old = len(self.distance)
+        self.distance = np.concatenate([self.distance, np.full(capacity - old, -1, np.int16)])
+        self.next_hop = np.concatenate([self.next_hop, np.full(capacity - old, -1, np.int8)])
+
+    def rebuild(self):
+        ''' compute the whole field with one breadth-first search from all sources '''
+        self.distance = self.graph.bfs(list(self.sources)).astype(np.int16)
+        self.update_next_hop(np.arange(self.graph.capacity))
+
+    def next_step(self, node):
+        ''' the id of the neighbour one step closer to the nearest source, -1 if there is none '''
+        hop = self.next_hop[node]
+        if hop < 0:
+            return -1
+        return int(self.graph.neighbour[node, hop])
+
+    def update_next_hop(self, nodes):
+        ''' recompute the next hop of the given nodes from the distances of their neighbours '''
+        nodes = np.asarray(nodes, np.int64)
+        candidates = self.graph.neighbour[nodes]
+        dist = np.where(candidates >= 0, self.distance[candidates], -1).astype(np.int32)
+        dist = np.where(dist >= 0, dist, UNREACHABLE)
+        hop = dist.argmin(axis=1)
+        closer = dist[np.arange(len(nodes)), hop] == self.distance[nodes].astype(np.int32) - 1
+        self.next_hop[nodes] = np.where(closer & (self.distance[nodes] > 0), hop, -1)
+
+    def _touched(self, changed):
+        ''' the changed nodes and their neighbours, whose next hop may be affected '''
+        neighbours = self.graph.neighbour[changed]
+        return np.union1d(changed, neighbours[neighbours >= 0])
+
+    def decrease(self, node, distance):
+        '''
+        node is at most distance steps away from a source,
+        propagate the shorter distances as long as they improve.
+        Returns the nodes whose distance changed.
+        '''
+        old = self.distance[node]
+        if 0 <= old <= distance:
+            return np.zeros(0, np.int64)
+        changed = []
+        current_dist = distance
+        current_nodes = np.array([node])
+        while current_nodes.size:
+            self.distance[current_nodes] = current_dist
+            changed.append(current_nodes)
+            candidates = self.graph.neighbour[current_nodes].ravel()
+            candidates = candidates[candidates >= 0]
+            old = self.distance[candidates]
+            current_nodes = np.unique(candidates[(old < 0) | (old > current_dist + 1)])
+            current_dist += 1
+        changed = np.concatenate(changed)
+        self.update_next_hop(self._touched(changed))
+        return changed
+
+    def node_added(self, node):
+        ''' a new node was connected to the graph, returns the nodes whose distance changed '''
+        neighbours = self.graph.neighbour[node]
+        connected = np.where(neighbours >= 0, self.distance[neighbours], -1)
+        reachable = connected >= 0
+        if not reachable.any():
+            self.next_hop[node] = -1
+            return np.zeros(0, np.int64)
+        hop = np.flatnonzero(reachable)[connected[reachable].argmin()]
+        distance = int(connected[hop]) + 1
+        if (connected[neighbours >= 0] >= 0).all() and (connected[reachable] <= distance + 1).all():
+            # the common case, no shortcut for the neighbours
+            self.distance[node] = distance
+            self.next_hop[node] = hop
+            return np.array([node])
+        return self.decrease(node, distance)
+
+    def add_source(self, node):
+        ''' node becomes a source of the field, returns the nodes whose distance changed '''
+        self.sources.add(node)
+        return self.decrease(node, 0)
+
+    def node_removed(self, node, neighbours):
+        '''
+        node with the given former neighbours was removed from the graph.
+        Returns the nodes whose distance changed.
+        '''
+        self.sources.discard(node)
+        old_dist = self.distance[node]
+        if old_dist < 0:
+            self.next_hop[node] = -1
+            return np.zeros(0, np.int64)
+        self.distance[node] = -1
+        self.next_hop[node] = -1
+
+        # invalidate all the nodes whose shortest path may lead over the removed node,
+        # if that is a large part of the graph a single full search is faster
+        distances = self.distance
+        current_nodes = neighbours[(distances[neighbours] > old_dist) & (distances[neighbours] != 0)]
+        invalidated = []
+        invalidated_dist = []  # the distances of the invalidated nodes before the removal
+        count = 0
+        while current_nodes.size:
+            count += current_nodes.size
+            if count * REBUILD_FRACTION > len(self.graph.node_ids):
+                before = distances.copy()
+                before[node] = old_dist
+                for nodes, dist in zip(invalidated, invalidated_dist):
+                    before[nodes] = dist
+                self.rebuild()
+                return np.flatnonzero(self.distance != before)
+            invalidated.append(current_nodes)
+            candidates = self.graph.neighbour[current_nodes]
+            parent_dist = distances[current_nodes][:, None]
+            dependent = (candidates >= 0) & (distances[candidates] > parent_dist)
+            invalidated_dist.append(distances[current_nodes])
+            distances[current_nodes] = -1
+            current_nodes = np.unique(candidates[dependent])
+            current_nodes = current_nodes[distances[current_nodes] >= 0]
+        if not invalidated:
+            self.update_next_hop(neighbours)
+            return np.array([node])
+        invalidated = np.unique(np.concatenate(invalidated))
+
+        # the boundary are the invalidated nodes next to a node with a correct distance,
+        # starting at the boundary nodes with the lowest distance do a bfs to recalculate
+        # the invalidated distances
+        unreachable = UNREACHABLE - 1
+        candidates = self.graph.neighbour[invalidated]
+        valid = np.where(candidates >= 0, distances[candidates], -1).astype(np.int32)
+        valid = np.where(valid >= 0, valid, unreachable)
+        boundary_dist = valid.min(axis=1) + 1
+        reachable = boundary_dist <= unreachable
+        pending = invalidated[reachable]
+        pending_dist = boundary_dist[reachable]
+
+        current_nodes = np.zeros(0, np.int64)
+        current_dist = pending_dist.min() if pending.size else 0
+        while current_nodes.size or pending.size:
+            seeds = pending_dist == current_dist
+            current_nodes = np.union1d(current_nodes, pending[seeds])
+            pending = pending[~seeds]
+            pending_dist = pending_dist[~seeds]
+            current_nodes = current_nodes[distances[current_nodes] < 0]
+            distances[current_nodes] = current_dist
+            candidates = self.graph.neighbour[current_nodes].ravel()
+            candidates = candidates[candidates >= 0]
+            current_nodes = np.unique(candidates[distances[candidates] < 0])
+            current_dist += 1
+
+        changed = np.append(invalidated, node)
+        self.update_next_hop(np.union1d(self._touched(invalidated), neighbours))
+        return changed
+
+class RouteCache:
+    '''
+    Routes to the points of interest shared by all guests.
+
+    A route is the list of node ids from a start node to the nearest source
+    of the flow field of a target. It is found by following the next hops of
+    the field, which are exact, so no search is needed. The cached routes to
+    a target form a tree: the cache holds the next node of every node on a
+    cached route, so caching a new route stops at the first node which is
+    already cached and the new route shares the remainder of its route.
+
+    A route stays a shortest route as long as the distances of its nodes do
+    not change, so after an edit only the routes through nodes whose distance
+    to the target changed are dropped.
+    '''
+    def __init__(self, graph):
+        self.graph = graph
+        self.successor = {}     # (node, target) -> the next node on the route from node, -1 at the target
+        self.predecessors = {}  # (node, target) -> set of the cached nodes whose route continues with node
+
+    def __len__(self):
+        return len(self.successor)
+
+    def clear(self):
+        self.successor.clear()
+        self.predecessors.clear()
+
+    def _cache(self, node, target):
+        ''' cache the route from node to target, returns False if the target cannot be reached '''
+        if (node, target) in self.successor:
+            return True
+        field = self.graph.flow_field(target)
+        if field is None or field.distance[node] < 0:
+            return False
+        while (node, target) not in self.successor:
+            step = field.next_step(node)
+            self.successor[node, target] = step
+            if step < 0:
+                break
+            self.predecessors.setdefault((step, target), set()).add(node)
+            node = step
+        return True
+
+    def route(self, node, target):
+        '''
+        The node ids of the route from node to target starting with node,
+        None if the target cannot be reached.
+        '''
+        if not self._cache(node, target):
+            return None
+        route = [node]
+        step = self.successor[node, target]
+        while step >= 0:
+            route.append(step)
+            step = self.successor[step, target]
+        return route
+
+    def next_step(self, node, target):
+        ''' the node id after node on the route to target, -1 at the target or if it cannot be reached '''
+        if not self._cache(node, target):
+            return -1
+        return self.successor[node, target]
+
+    def invalidate(self, target, changed):
+        ''' drop the routes to target which pass one of the nodes in changed '''
+        changed = np.asarray(changed)
+        if len(changed) > len(self.successor):
+            # after a large repair look the cached nodes up in a mask of the changed ones
+            mask = np.zeros(self.graph.capacity, bool)
+            mask[changed] = True
+            dropped = [node for node, route_target in self.successor if route_target == target and mask[node]]
         else:
-            assert False, 'illegal ptype %r' % self.ptype
+            dropped = changed.tolist()
+        while dropped:
+            node = dropped.pop()
+            step = self.successor.pop((node, target), None)
+            if step is None:
+                continue
+            nodes = self.predecessors.get((step, target))
+            if nodes is not None:
+                nodes.discard(node)
+                if not nodes:
+                    del self.predecessors[step, target]
+            # the routes of the predecessors continue through node
+            dropped.extend(self.predecessors.pop((node, target), ()))
 
 class PathGraph:
-    def __init__(self):
-        self.path = {}
-        self.edges = defaultdict(list)
+    '''
+    Graph of the path elements.
+
+    Every path element is a node with an integer id. The node data is kept in
+    flat arrays indexed by the id:
+     * position -- (x, y, z) of the element
+     * ptype -- the TYPE_ constant of the element
+     * connection_bitfield -- the MASK_ bits of the connected sides
+     * neighbour -- the neighbour id on each side (see SLOT) or -1
+
+    Ids of removed elements are reused. adjacency() gives the neighbours in
+    compressed sparse row form.
+
+    distance_to_poi holds a FlowField for every point of interest,
+    category_fields a FlowField towards the nearest point of interest of
+    each category (e.g. 'shop'). The fields are repaired incrementally on
+    every change and the routes in the RouteCache routes which are affected
+    by the change are dropped. Inside a bulk() block the repairs are deferred
+    and all fields are computed with one breadth-first search each at the end.
+    '''
+    def __init__(self, capacity=64):
+        self.node_ids = {}
+        self.path = PathView(self)
+        self.edges = {}
         self.distance_to_poi = {}
-
-    def add_path_element(self, pos, ptype, poi_ref=None):
-        element = PathElement(pos, ptype)
-        assert pos not in self.path
-        self.path[pos] = element
-
-        for attpt, mask in element.attachment_points():
-            nbs = self.edges[attpt]
-            if nbs:
-                assert len(nbs) == 1, 'double edge'
-                nb = nbs[0]
-                element.neighbours.append(nb)
-                element.connection_bitfield |= mask
-                nb.neighbours.append(element)
-                nb.connection_bitfield |= OPP_MASK[mask]
-            nbs.append(element)
-
-        for poi, distances in self.distance_to_poi.items():
-            if poi == poi_ref:
-                continue
-            connected_neighbours = [nb for nb in element.neighbours if nb in distances]
-            if not connected_neighbours:
+        self.category_fields = {}
+        self.routes = RouteCache(self)
+        self.in_bulk = False
+        self.free = []
+        self.capacity = 0
+        self.position = np.zeros((0, 3), np.int32)
+        self.ptype = np.zeros(0, np.int8)
+        self.connection_bitfield = np.zeros(0, np.int8)
+        self.neighbour = np.zeros((0, 4), np.int32)
+        self._adjacency = None
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        old = self.capacity
+
+        def grown(array, fill):
+            result = np.full((capacity,) + array.shape[1:], fill, array.dtype)
+            result[:old] = array
+            return result
+
+        self.position = grown(self.position, 0)
+        self.ptype = grown(self.ptype, 0)
+        self.connection_bitfield = grown(self.connection_bitfield, 0)
+        self.neighbour = grown(self.neighbour, -1)
+        for _, field in self.flow_fields():
+            field.grow(capacity)
+        self.free.extend(range(capacity - 1, old - 1, -1))
+        self.capacity = capacity
+
+    def flow_fields(self):
+        ''' (target, FlowField) of all points of interest and categories '''
+        yield from self.distance_to_poi.items()
+        yield from self.category_fields.items()
+
+    def adjacency(self):
+        '''
+        The neighbours of all nodes in compressed sparse row form.
+
+        Returns (indptr, indices), the neighbours of node i are indices[indptr[i]:indptr[i + 1]].
+        The arrays are cached until the graph is changed.
+        '''
+        if self._adjacency is None:
+            connected = self.neighbour >= 0
+            indptr = np.zeros(self.capacity + 1, np.int32)
+            np.cumsum(connected.sum(axis=1), out=indptr[1:])
+            self._adjacency = indptr, self.neighbour[connected]
+        return self._adjacency
+
+    @contextlib.contextmanager
+    def bulk(self):
+        ''' context manager deferring the flow field repairs to the end of the block '''
+        assert not self.in_bulk
+        self.in_bulk = True
+        try:
+            yield self
+        finally:
+            self.in_bulk = False
+            for _, field in self.flow_fields():
+                field.rebuild()
+            self.routes.clear()
+
+    def bfs(self, sources):
+        ''' distances of all nodes to the nearest of the source nodes, -1 for unreachable nodes '''
+        indptr, indices = self.adjacency()
+        distances = np.full(self.capacity, -1, np.int32)
+        frontier = np.unique(np.asarray(sources, np.int32))
+        distance = 0
+        while frontier.size:
+            distances[frontier] = distance
+            distance += 1
+            starts = indptr[frontier]
+            counts = indptr[frontier + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+            candidates = indices[offsets + np.arange(counts.sum())]
+            frontier = np.unique(candidates[distances[candidates] < 0])
+        return distances
+
+    def add_path_element(self, pos, ptype, poi_ref=None, category=None):
+        '''
+        Add a path element at pos.
+
+        Points of interest are given a reference poi_ref and optionally a category,
+        the nearest point of interest of a category can be found with category_fields.
+        '''
+        assert pos not in self.node_ids
+        if not self.free:
+            self._grow(2 * self.capacity)
+        node = self.free.pop()
+        self.node_ids[pos] = node
+        self.position[node] = pos
+        self.ptype[node] = ptype
+        self.connection_bitfield[node] = 0
+        self.neighbour[node] = -1
+        self._adjacency = None
+
+        for attpt, mask in attachment_points(pos, ptype):
+            nb = self.edges.get(attpt)
+            if nb is None:
+                self.edges[attpt] = node
                 continue
-            current_dist = 1 + min(distances[nb] for nb in connected_neighbours)
-            current_nodes = [element]
-            while current_nodes:
-                next_nodes = []
-                for n in current_nodes:
-                    distances[n] = current_dist
-                    next_nodes.extend(nb for nb in n.neighbours if nb in distances and distances[nb] > current_dist + 1)
-                current_nodes = next_nodes
-                current_dist += 1
+            slot = SLOT[mask]
+            assert self.neighbour[nb, OPP_SLOT[slot]] < 0, 'double edge'
+            self.neighbour[node, slot] = nb
+            self.connection_bitfield[node] |= mask
+            self.neighbour[nb, OPP_SLOT[slot]] = node
+            self.connection_bitfield[nb] |= OPP_MASK[mask]
+
+        if not self.in_bulk:
+            for target, field in self.flow_fields():
+                self.routes.invalidate(target, field.node_added(node))
 
         if ptype in (TYPE_POI_XU, TYPE_POI_YU, TYPE_POI_XD, TYPE_POI_YD):
-            distances = {}
-            current_dist = 0
-            current_nodes = [element]
-            while current_nodes:
-                next_nodes = []
-                for n in current_nodes:
-                    distances[n] = current_dist
-                    next_nodes.extend(nb for nb in n.neighbours if nb not in distances)
-                current_nodes = next_nodes
-                current_dist += 1
-
-            self.distance_to_poi[poi_ref] = distances
+            self.distance_to_poi[poi_ref] = FlowField(self, [node])
+            if category is not None:
+                if category not in self.category_fields:
+                    self.category_fields[category] = FlowField(self)
+                field = self.category_fields[category]
+                if self.in_bulk:
+                    field.sources.add(node)
+                else:
+                    self.routes.invalidate(category, field.add_source(node))
 
     def remove_path_element(self, pos):
-        element = self.path.pop(pos)
-
-        for attpt, mask in element.attachment_points():
-            nbs = self.edges[attpt]
-            nbs.remove(element)
-            if nbs:
-                assert len(nbs) == 1, 'double edge'
-                nb = nbs[0]
-                nb.neighbours.remove(element)
-                nb.connection_bitfield &= ~OPP_MASK[mask]
+        node = self.node_ids.pop(pos)
+        neighbours = self.neighbour[node]
+        neighbours = neighbours[neighbours >= 0]
+
+        for attpt, mask in attachment_points(pos, self.ptype[node]):
+            nb = self.neighbour[node, SLOT[mask]]
+            if nb >= 0:
+                self.neighbour[nb, OPP_SLOT[SLOT[mask]]] = -1
+                self.connection_bitfield[nb] &= ~OPP_MASK[mask]
+                self.edges[attpt] = nb
             else:
                 del self.edges[attpt]
-
-        for distances in self.distance_to_poi.values():
-            if element in distances:
-                current_nodes = [element]
-                boundary = defaultdict(list)
-
-                while current_nodes:
-                    next_nodes = []
-                    for n in current_nodes:
-                        old_dist = distances[n]
-                        del distances[n]
-                        for nb in n.neighbours:
-                            if nb in distances:
-                                if distances[nb] > old_dist:
-                                    next_nodes.append(nb)
-                                elif n is not element:
-                                    new_dist = 1 + distances[nb]
-                                    boundary[new_dist].append(n)
-                    current_nodes = next_nodes
-                # now all invalidated distances have been removed from the distances dictionary
-                # boundary contains all the nodes with a correct distance
-
-                # starting at the boundary nodes with the lowest distance do a bfs to recalculate
-                # the invalidated distances
-                if boundary:
-                    current_dist = min(boundary)
-                    current_nodes = boundary[current_dist]
-                    while current_nodes:
-                        next_nodes = []
-                        for n in current_nodes:
-                            distances[n] = current_dist
-                            next_nodes.extend(nb for nb in n.neighbours if nb not in distances)
-                        current_nodes = next_nodes
-                        current_dist += 1
-                        current_nodes.extend(boundary[current_dist])
-            assert element not in distances
+        self.neighbour[node] = -1
+        self.connection_bitfield[node] = 0
+        self.free.append(node)
+        self._adjacency = None
+
+        for target, field in self.flow_fields():
+            if self.in_bulk:
+                field.sources.discard(node)
+            else:
+                self.routes.invalidate(target, field.node_removed(node, neighbours))
 
     def get_distance_to_poi(self, poi_ref, pos):
-        return self.distance_to_poi[poi_ref].get(self.path[pos], None)
+        distance = self.distance_to_poi[poi_ref].distance[self.node_ids[pos]]
+        if distance < 0:
+            return None
+        return int(distance)
+
+    def flow_field(self, target):
+        ''' the FlowField towards a category of points of interest or a single one, None if there is none '''
+        field = self.category_fields.get(target)
+        if field is None:
+            field = self.distance_to_poi.get(target)
+        return field
+
+    def next_step(self, target, pos):
+        ''' the PathElement after pos on the cached route to target, None at the target or if it cannot be reached '''
+        node = self.routes.next_step(self.node_ids[pos], target)
+        if node < 0:
+            return None
+        return PathElement(self, node)
+
+    def at_target(self, target, pos):
+        ''' whether pos is one of the points of interest of target '''
+        field = self.flow_field(target)
+        return field is not None and self.node_ids[pos] in field.sources
 
 def test():
+    import random
 
     def assert_eq(a, b):
         assert a == b, '%s != %s' % (a, b)
@@ -221,6 +637,109 @@ def test():
     assert_eq(graph.get_distance_to_poi('A', (0, 0, 0)), 11)
     assert_eq(graph.get_distance_to_poi('B', (1, 3, 0)), 10)
 
+    def check_fields(graph):
+        ''' the incrementally repaired flow fields must match a full search '''
+        live = np.array(sorted(graph.node_ids.values()))
+        for target, field in graph.flow_fields():
+            expected = graph.bfs(sorted(field.sources))
+            assert (field.distance[live] == expected[live]).all(), target
+            for node in live.tolist():
+                step = field.next_step(node)
+                if expected[node] > 0:
+                    assert_eq(expected[step], expected[node] - 1)
+                else:
+                    assert_eq(step, -1)
+            # so must the cached routes
+            for (node, route_target), step in graph.routes.successor.items():
+                if route_target == target:
+                    assert_eq(expected[step] if step >= 0 else -1, expected[node] - 1)
+
+    # random edits of flat paths and points of interest, two of them in the category 'shop'
+    random.seed(0)
+    graph = PathGraph()
+    pois = {(0, 2, 0): ('P0', 'shop'), (0, 6, 0): ('P1', 'shop'), (0, 9, 0): ('P2', None)}
+    present = set()
+    for step in range(400):
+        if random.random() < 0.1:
+            pos = random.choice(list(pois))
+        else:
+            pos = (random.randrange(1, 8), random.randrange(0, 10), 0)
+        if pos in present:
+            graph.remove_path_element(pos)
+            present.remove(pos)
+        elif pos in pois:
+            graph.add_path_element(pos, TYPE_POI_XU, *pois[pos])
+            present.add(pos)
+        else:
+            graph.add_path_element(pos, TYPE_FLAT)
+            present.add(pos)
+        for target, _ in list(graph.flow_fields()):
+            if present:
+                graph.routes.route(graph.node_ids[random.choice(sorted(present))], target)
+        check_fields(graph)
+
+    # inside a bulk block the fields are not repaired, at the end they are rebuilt
+    with graph.bulk():
+        for y in range(10):
+            if (8, y, 0) not in present:
+                graph.add_path_element((8, y, 0), TYPE_FLAT)
+                present.add((8, y, 0))
+        for _, field in graph.flow_fields():
+            assert_eq(field.distance[graph.node_ids[8, 0, 0]], -1)
+    check_fields(graph)
+
+    # only the cached routes through nodes whose distance changed are dropped
+    graph = PathGraph()
+    graph.add_path_element((0, 0, 0), TYPE_POI_XU, 'A')
+    for pos in [(x, 0, 0) for x in range(1, 6)] + [(5, 1, 0), (5, 2, 0), (3, 1, 0), (3, 2, 0)]:
+        graph.add_path_element(pos, TYPE_FLAT)
+
+    # path now looks like
+    # A----+
+    #    | |
+    #    | |
+
+    routes = graph.routes
+    far = graph.node_ids[5, 2, 0]
+    near = graph.node_ids[3, 2, 0]
+    assert_eq(len(routes.route(far, 'A')), 8)
+    assert_eq(len(routes), 8)
+    # the second route joins the first one and shares its cached remainder
+    assert_eq(len(routes.route(near, 'A')), 6)
+    assert_eq(len(routes), 10)
+
+    graph.remove_path_element((5, 1, 0))
+    assert (far, 'A') not in routes.successor
+    assert (near, 'A') in routes.successor
+    assert_eq(len(routes), 8)
+    assert_eq(routes.next_step(near, 'A'), graph.node_ids[3, 1, 0])
+    assert_eq(routes.route(far, 'A'), None)
+
+    graph.remove_path_element((0, 0, 0))
+    assert_eq(len(routes), 0)
+    assert_eq(routes.route(near, 'A'), None)
+
+    # a route is dropped when a later node of it gets longer, even if the
+    # distance of its start stays the same
+    graph = PathGraph()
+    graph.add_path_element((0, 1, 0), TYPE_POI_XU, 'A')
+    for pos in [(1, 1, 0), (1, 0, 0), (2, 0, 0), (3, 0, 0), (1, 2, 0), (2, 2, 0), (3, 2, 0), (3, 1, 0)]:
+        graph.add_path_element(pos, TYPE_FLAT)
+
+    # path now looks like
+    #  +-+-+
+    #  |   |
+    # A+   +
+    #  |   |
+    #  +-+-+
+
+    routes = graph.routes
+    start = graph.node_ids[3, 1, 0]
+    assert_eq(len(routes.route(start, 'A')), 6)
+    _, y, _ = graph.position[routes.next_step(start, 'A')].tolist()
+    graph.remove_path_element((2, y, 0))
+    assert_eq(graph.position[routes.next_step(start, 'A')].tolist(), [3, 2 - y, 0])
+
 
 if __name__ == '__main__':
     test()
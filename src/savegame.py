@@ -0,0 +1,340 @@
+'''
+Reading and writing saved games.
+
+The format is selected by the file extension:
+ * .json -- the Simulation.serialize dictionary as JSON text
+ * .opk -- a compact binary format
+
+The binary format starts with a fixed header (see HEADER) followed by the
+optionally compressed payload. The payload consists of four sections, each
+prefixed with its length in bytes as little endian uint32:
+ 1. the path connection bitfield of every tile as int8, column by column, -1 where there is no path
+ 2. the scene objects as JSON text
+ 3. the names of the guest targets as JSON list
+ 4. the guests as fixed width records of the type GUEST_RECORD, the target of
+    a guest is its index in the list of section 3, -1 for no target
+
+@author: leonhard
+'''
+import json
+import logging
+import lzma
+import os
+import queue
+import struct
+import threading
+import zlib
+from math import isnan
+
+import numpy as np
+
+import guests
+from simulation import Simulation, Person
+
+MAGIC = b'OPRK'
+VERSION = 2
+
+# magic, version, compression, world width, world height, time
+HEADER = struct.Struct('<4sHHiid')
+SECTION_LENGTH = struct.Struct('<I')
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+COMPRESSION = {None: COMPRESSION_NONE, 'zlib': COMPRESSION_ZLIB, 'lzma': COMPRESSION_LZMA}
+
+# the bytes of the UTF-8 guest names in the guest records, longer names are cut
+NAME_SIZE = 32
+
+# the columns of the GuestStore saved in the guest records
+GUEST_COLUMNS = [('x', '<f8'),
+                 ('y', '<f8'),
+                 ('arrival_time', '<f8'),
+                 ('action_started', '<f8'),
+                 ('waypoint_x', '<f8'),
+                 ('waypoint_y', '<f8'),
+                 ('action', 'i1'),
+                 ('palette', 'i1')]
+
+GUEST_RECORD = np.dtype([('name', 'S%d' % NAME_SIZE)] + GUEST_COLUMNS + [('target', '<i4')])
+
+def encode_name(name):
+    ''' name as UTF-8 of at most NAME_SIZE bytes, cut at a character boundary '''
+    return name.encode('utf8')[:NAME_SIZE].decode('utf8', 'ignore').encode('utf8')
+
+def is_binary(filename):
+    return os.path.splitext(filename)[1] == '.opk'
+
+class Snapshot:
+    '''
+    Copy of the simulation state to write to a save game.
+
+    Taking a snapshot only copies arrays and the guest names, so it is cheap
+    enough for the main thread. Encoding it as binary save game or as JSON can
+    then be done in the background.
+    '''
+    def __init__(self, simulation):
+        store = simulation.guests
+        slots = np.flatnonzero(store.alive)
+        self.world_width = simulation.world_width
+        self.world_height = simulation.world_height
+        self.time = simulation.time
+        self.path_map = simulation.path_map.astype(np.int8)
+        self.scene = [dict(element.serialize()) for element in simulation.scene]
+        views = [store.views[slot] for slot in slots]
+        self.names = [view.name for view in views]
+        self.targets = [view.target for view in views]
+        self.guests = np.zeros(len(slots), GUEST_RECORD)
+        for name, _ in GUEST_COLUMNS:
+            self.guests[name] = getattr(store, name)[slots]
+        self.guests['x'], self.guests['y'] = store.positions(slots, simulation.time)
+
+    def serialize(self):
+        ''' the Simulation.serialize dictionary of the simulation state '''
+        columns = [self.guests[name].tolist() for name in ('x', 'y', 'arrival_time', 'palette', 'action',
+                                                           'action_started', 'waypoint_x', 'waypoint_y')]
+        persons = [{'name': name,
+                    'pos': (x, y),
+                    't': arrival_time,
+                    'pal': palette,
+                    'action': guests.ACTIONS[action],
+                    'action_started': action_started,
+                    'target': target,
+                    'next_waypoint': None if isnan(waypoint_x) else (waypoint_x, waypoint_y)}
+                   for name, target, x, y, arrival_time, palette, action, action_started, waypoint_x, waypoint_y
+                   in zip(self.names, self.targets, *columns)]
+        return {'world_width': self.world_width,
+                'world_height': self.world_height,
+                'time': self.time,
+                'map': [[{'p': None if path < 0 else path} for path in column] for column in self.path_map.tolist()],
+                'scene': self.scene,
+                'persons': persons}
+
+def save(simulation, filename, compression='zlib'):
+    write(Snapshot(simulation), filename, compression)
+
+def write(snapshot, filename, compression='zlib'):
+    '''
+    Write a snapshot to filename.
+
+    The data is written to a temporary file which then replaces filename, so
+    filename always holds a complete save game.
+    '''
+    if is_binary(filename):
+        data = encode(snapshot, compression)
+    else:
+        data = json.dumps(snapshot.serialize()).encode('ascii')
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as fp:
+        fp.write(data)
+    os.replace(temp, filename)
+
+def load(filename):
+    if is_binary(filename):
+        with open(filename, 'rb') as fp:
+            return decode(fp.read())
+    else:
+        with open(filename, 'rt', encoding='utf8') as fp:
+            return Simulation.deserialize(json.load(fp))
+
+def encode(snapshot, compression='zlib'):
+    ''' the binary save game of the snapshot as bytes '''
+    targets = sorted({target for target in snapshot.targets if target is not None})
+    target_index = {target: index for index, target in enumerate(targets)}
+    records = snapshot.guests.copy()
+    records['name'] = [encode_name(name) for name in snapshot.names]
+    records['target'] = [target_index.get(target, -1) for target in snapshot.targets]
+    sections = [snapshot.path_map.tobytes(),
+                json.dumps(snapshot.scene).encode('utf8'),
+                json.dumps(targets).encode('utf8'),
+                records.tobytes()]
+    payload = b''.join(SECTION_LENGTH.pack(len(section)) + section for section in sections)
+
+    code = COMPRESSION[compression]
+    if code == COMPRESSION_ZLIB:
+        payload = zlib.compress(payload)
+    elif code == COMPRESSION_LZMA:
+        payload = lzma.compress(payload)
+    return HEADER.pack(MAGIC, VERSION, code, snapshot.world_width, snapshot.world_height, snapshot.time) + payload
+
+def decode(data):
+    ''' create a simulation from a binary save game '''
+    magic, version, code, width, height, time = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise Exception('not an OpenPark save game')
+    if version != VERSION:
+        raise Exception('unsupported save version {}'.format(version))
+
+    payload = data[HEADER.size:]
+    if code == COMPRESSION_ZLIB:
+        payload = zlib.decompress(payload)
+    elif code == COMPRESSION_LZMA:
+        payload = lzma.decompress(payload)
+    elif code != COMPRESSION_NONE:
+        raise Exception('unknown compression {}'.format(code))
+
+    sections = []
+    offset = 0
+    while offset < len(payload):
+        length, = SECTION_LENGTH.unpack_from(payload, offset)
+        offset += SECTION_LENGTH.size
+        sections.append(payload[offset:offset + length])
+        offset += length
+    path_map, scene, targets, records = sections
+
+    simulation = Simulation(width, height)
+    simulation.restore_scene(json.loads(scene.decode('utf8')))
+    path_map = np.frombuffer(path_map, np.int8).reshape(width, height)
+    simulation.add_paths(np.argwhere(path_map >= 0).tolist())
+
+    simulation.time = time
+    targets = json.loads(targets.decode('utf8'))
+    records = np.frombuffer(records, GUEST_RECORD)
+    store = simulation.guests
+    slots = store.add_many(len(records), Person.SPEED)
+    for slot, name, target in zip(slots.tolist(), records['name'].tolist(), records['target'].tolist()):
+        person = Person.from_slot(simulation, name.decode('utf8'), slot)
+        if target >= 0:
+            person.target = targets[target]
+    for name, _ in GUEST_COLUMNS:
+        getattr(store, name)[slots] = records[name]
+    store.depart_time[slots] = time
+    for slot in slots.tolist():
+        simulation.schedule(slot)
+    store.update_poses(time)
+    return simulation
+
+class BackgroundSaver:
+    '''
+    Writes save games in a worker thread.
+
+    save() takes the snapshot on the calling thread and returns immediately.
+    If a save is requested while the previous one is still waiting to be written
+    only the newer one is written.
+    '''
+    def __init__(self, compression='zlib'):
+        self.compression = compression
+        self.pending = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, name='BackgroundSaver', daemon=True)
+        self.thread.start()
+
+    def save(self, simulation, filename):
+        job = (Snapshot(simulation), filename)
+        while True:
+            try:
+                self.pending.put_nowait(job)
+                return
+            except queue.Full:
+                try:
+                    self.pending.get_nowait()  # drop the older snapshot
+                    self.pending.task_done()
+                except queue.Empty:
+                    pass
+
+    def run(self):
+        while True:
+            job = self.pending.get()
+            try:
+                if job is None:
+                    return
+                state, filename = job
+                write(state, filename, self.compression)
+                logging.info('Saved {}'.format(os.path.abspath(filename)))
+            except Exception:
+                logging.exception('Saving failed')
+            finally:
+                self.pending.task_done()
+
+    def wait(self):
+        ''' block until all requested saves are written '''
+        self.pending.join()
+
+    def close(self):
+        ''' write the pending save and stop the worker thread '''
+        self.wait()
+        self.pending.put(None)
+        self.thread.join()
+
+
+def test():
+    import random
+    import tempfile
+
+    def assert_eq(a, b):
+        assert a == b, '%s != %s' % (a, b)
+
+    directory = tempfile.mkdtemp()
+
+    # an empty park without any laid paths
+    for extension in ('.json', '.opk'):
+        filename = os.path.join(directory, 'empty' + extension)
+        save(Simulation(8, 8), filename)
+        loaded = load(filename)
+        assert_eq((loaded.world_width, loaded.world_height), (8, 8))
+        assert_eq(int((loaded.path_map >= 0).sum()), 0)
+        assert_eq(len(loaded.guests), 0)
+
+    # a park with guests walking on its paths and without its shop
+    random.seed(0)
+    simulation = Simulation(16, 16)
+    for y in range(12):
+        simulation.set_path(5, y, True)
+    for x in range(12):
+        simulation.set_path(x, 4, True)
+    simulation.remove_scenery(4, 4, 0)
+    simulation.person_freq = 2
+    for _ in range(3000):
+        simulation.update(0.01)
+    persons = list(simulation.guests)
+    persons[0].name = 'Guest with an overly long name:ü'  # the umlaut takes bytes 32 and 33
+    persons[1].target = 'a target with a long name'
+    assert len(persons) > 10
+
+    # the snapshot holds the same state as the serialized simulation
+    assert_eq(json.loads(json.dumps(Snapshot(simulation).serialize())), json.loads(json.dumps(simulation.serialize())))
+
+    for extension, compression in (('.json', None), ('.opk', None), ('.opk', 'zlib'), ('.opk', 'lzma')):
+        filename = os.path.join(directory, 'park' + extension)
+        save(simulation, filename, compression)
+        loaded = load(filename)
+        assert_eq(loaded.time, simulation.time)
+        assert (loaded.path_map == simulation.path_map).all()
+        assert_eq([element.serialize() for element in loaded.scene], [element.serialize() for element in simulation.scene])
+        assert_eq(sorted(loaded.path_graph.path), sorted(simulation.path_graph.path))
+        assert_eq(len(loaded.guests), len(persons))
+        for original, copy in zip(persons, loaded.guests):
+            if original is persons[0] and extension == '.opk':
+                assert_eq(copy.name, 'Guest with an overly long name:')
+            else:
+                assert_eq(copy.name, original.name)
+            assert_eq(copy.target, original.target)
+            assert_eq(copy.action, original.action)
+            assert_eq(copy.next_waypoint, original.next_waypoint)
+            assert abs(copy.x - original.x) < 1e-9 and abs(copy.y - original.y) < 1e-9
+
+    # JSON save games of older versions have no arrival time and palette
+    data = simulation.serialize()
+    for person in data['persons']:
+        del person['t'], person['pal']
+    assert_eq(len(Simulation.deserialize(data).guests), len(persons))
+
+    # saving in the background
+    saver = BackgroundSaver()
+    filename = os.path.join(directory, 'background.opk')
+    saver.save(simulation, filename)
+    saver.close()
+    assert_eq(len(load(filename).guests), len(persons))
+
+    # save games of an unknown version
+    data = bytearray(encode(Snapshot(Simulation(8, 8))))
+    struct.pack_into('<H', data, 4, VERSION + 1)
+    try:
+        decode(bytes(data))
+    except Exception as e:
+        assert_eq(str(e), 'unsupported save version {}'.format(VERSION + 1))
+    else:
+        assert False, 'an unknown version was loaded'
+
+
+if __name__ == '__main__':
+    test()
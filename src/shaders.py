@@ -27,6 +27,86 @@ void main()
 }
 '''
 
+vertex_sprite_instanced = b'''
+#version 130
+// one instance per sprite, the quad is expanded from gl_VertexID
+in vec4 instance_position;  // x, y, z, direction in degrees
+in vec4 instance_frames;    // first frame of the pose, number of frames, palette
+in int instance_key;
+
+varying vec4 texcoord_;
+
+uniform vec2 window_size;
+uniform vec2 screen_origin;
+
+uniform float time;
+uniform float fps;
+uniform vec2 frame_origin;   // texture coordinates of the first frame
+uniform vec2 frame_size;     // texture coordinates size of a frame
+uniform vec3 sprite_offset;  // half width, top and bottom of the quad in world units
+uniform vec3 directions;     // start_deg, turn_deg, number of directions
+uniform vec2 layer;          // u offset and zbuffer mode of the layer, mode < 0 is automatic
+
+const float VOXEL_HEIGHT = 24.0;
+const float VOXEL_Y_SIDE = 24.0;
+const float VOXEL_X_SIDE = 48.0;
+
+const float ZMODE_SUBVOX_BACK = 5.0;
+const float ZMODE_SUBVOX_MIDDLE = 3.0;
+const float ZMODE_SUBVOX_FRONT = 2.0;
+
+// left/right and bottom/top of the four corners of the quad
+const vec2 CORNERS[4] = vec2[4](vec2(0.0, 0.0), vec2(0.0, 1.0), vec2(1.0, 1.0), vec2(1.0, 0.0));
+
+flat out int object_id_;
+
+float zbuffer(vec2 pos, float mode)
+{
+    // see simulationview.zbuffer
+    vec2 tile = floor(pos);
+    vec2 frac = pos - tile;
+    if (mode < 0.0)
+    {
+        if (frac.x >= 0.5 && frac.y >= 0.5)
+            mode = ZMODE_SUBVOX_BACK;
+        else if (frac.x < 0.5 && frac.y < 0.5)
+            mode = ZMODE_SUBVOX_FRONT;
+        else
+            mode = ZMODE_SUBVOX_MIDDLE;
+    }
+    return (32.0 * mode + 65536.0 * (tile.x + tile.y)) / 16777216.0;
+}
+
+void main()
+{
+    vec2 corner = CORNERS[gl_VertexID % 4];
+
+    // see Sprite.get_coordinates
+    float dir;
+    if (directions.y > 0.0)
+        dir = floor(mod(instance_position.w - directions.x + 360.0, 360.0) / directions.y);
+    else
+        dir = floor(mod(-instance_position.w + directions.x + 360.0, 360.0) / -directions.y);
+    dir = mod(dir, directions.z);
+    float frame = mod(floor(time * fps), instance_frames.y) + instance_frames.x;
+    vec2 uv = frame_origin + frame_size * vec2(dir + corner.x, frame + 1.0 - corner.y);
+
+    float side = 2.0 * corner.x - 1.0;
+    vec4 position = vec4(instance_position.x + side * sprite_offset.x,
+                         instance_position.y - side * sprite_offset.x,
+                         instance_position.z + mix(sprite_offset.z, sprite_offset.y, corner.y),
+                         zbuffer(instance_position.xy, layer.y));
+
+    vec2 world;
+    world = vec2(VOXEL_X_SIDE * (position.x - position.y), VOXEL_Y_SIDE * (position.x + position.y) + VOXEL_HEIGHT * position.z);
+    world = world + screen_origin;
+    world = 2.0 * world / window_size - vec2(1.0, -1.0);
+    texcoord_ = vec4(uv.x + layer.x, uv.y, instance_frames.z, 0.0);
+    gl_Position = vec4(world, position.w, 1.0);
+    object_id_ = instance_key;
+}
+'''
+
 fragment_scene = b'''
 #version 130
 
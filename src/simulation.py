@@ -5,8 +5,11 @@ Created on 8 Jul 2015
 '''
 
 import enum
+import heapq
+import numpy as np
 import path_graph
-from math import floor
+import guests
+from math import floor, isnan
 from itertools import count
 
 @enum.unique
@@ -58,109 +61,162 @@ class Object:
         return Object(**data)
 
 
+def _column(name):
+    ''' a property reading and writing the column name of the guest store '''
+    def fget(self):
+        return getattr(self.simu.guests, name)[self.slot].item()
+
+    def fset(self, value):
+        getattr(self.simu.guests, name)[self.slot] = value
+
+    return property(fget, fset)
+
+def _enum_column(name, values):
+    ''' a property mapping the integer column name to the strings in values '''
+    def fget(self):
+        return values[getattr(self.simu.guests, name)[self.slot]]
+
+    def fset(self, value):
+        getattr(self.simu.guests, name)[self.slot] = values.index(value)
+
+    return property(fget, fset)
+
 class Person:
+    '''
+    A guest of the park.
+
+    The state of the guest is stored in the GuestStore of the simulation,
+    a Person object is a view onto one slot of the store.
+    '''
+    SPEED = 0.45
+
     def __init__(self, simu, name, x, y, t, palette):
         self.simu = simu
         self.name = name
-        self.x = x
-        self.y = y
-        self.action = 'wait'
-        self.pose = 'stand'
-        self.action_started = 0
         self.target = None
-        self.next_waypoint = None
-        self.last = None
-        self.direction = 0
-        self.speed = 0.45
-        self.arrival_time = t
-        self.palette = palette
+        self.slot = simu.guests.add(self, x, y, t, palette, self.SPEED)
+        simu.guests.depart_time[self.slot] = simu.time
+        simu.schedule(self.slot)
+
+    @staticmethod
+    def from_slot(simu, name, slot):
+        ''' create the view for a slot allocated with GuestStore.add_many '''
+        self = Person.__new__(Person)
+        self.simu = simu
+        self.name = name
+        self.target = None
+        self.slot = slot
+        simu.guests.views[slot] = self
+        return self
 
+    action_started = _column('action_started')
+    direction = _column('direction')
+    palette = _column('palette')
+    speed = _column('speed')
+    arrival_time = _column('arrival_time')
+    pose = _enum_column('pose', guests.POSES)
+
+    @property
+    def position(self):
+        ''' the current (x, y) of the guest '''
+        return self.simu.guests.position(self.slot, self.simu.time)
+
+    @property
+    def x(self):
+        return self.position[0]
+
+    @property
+    def y(self):
+        return self.position[1]
+
+    @property
+    def action(self):
+        return guests.ACTIONS[self.simu.guests.action[self.slot]]
+
+    @action.setter
+    def action(self, value):
+        store = self.simu.guests
+        store.settle(self.slot, self.simu.time)
+        store.action[self.slot] = guests.ACTIONS.index(value)
+        self.simu.schedule(self.slot)
+
+    @property
+    def next_waypoint(self):
+        store = self.simu.guests
+        if isnan(store.waypoint_x[self.slot]):
+            return None
+        return store.waypoint_x[self.slot].item(), store.waypoint_y[self.slot].item()
+
+    @next_waypoint.setter
+    def next_waypoint(self, waypoint):
+        store = self.simu.guests
+        store.settle(self.slot, self.simu.time)
+        if waypoint is None:
+            store.waypoint_x[self.slot] = store.waypoint_y[self.slot] = float('nan')
+        else:
+            store.waypoint_x[self.slot], store.waypoint_y[self.slot] = waypoint
+        self.simu.schedule(self.slot)
+
+    @property
+    def last(self):
+        store = self.simu.guests
+        if not store.has_last[self.slot]:
+            return None
+        return (store.last_x[self.slot].item(), store.last_y[self.slot].item(), 0)
+
+    @last.setter
+    def last(self, pos):
+        store = self.simu.guests
+        store.has_last[self.slot] = pos is not None
+        if pos is not None:
+            store.last_x[self.slot], store.last_y[self.slot], _ = pos
 
     def get_next_waypoint(self):
-        X = floor(self.x)
-        Y = floor(self.y)
-        p = self.simu.path_graph.path.get((X, Y, 0))
+        '''
+        The point to walk to next.
+
+        Guests with a target follow the shared cached route to the target, the
+        others and the guests which cannot reach their target take a random
+        turn but do not walk back if there is another way.
+        '''
+        p = self.simu.path_graph.path.get((floor(self.x), floor(self.y), 0))
         if p is None:  # we are not on a path
             return None
         if not p.neighbours:  # we are on an isolated path
             return None
-        nbs = p.neighbours
-        if len(nbs) > 1:
-            nbs = [nb for nb in nbs if nb.pos != self.last]
+        graph = self.simu.path_graph
+        if self.target is not None and graph.at_target(self.target, p.pos):
+            self.target = self.simu.choose_target(self.target)
+        nb = None
+        if self.target is not None:
+            nb = graph.next_step(self.target, p.pos)
+        if nb is None:
+            nbs = p.neighbours
+            if len(nbs) > 1:
+                nbs = [nb for nb in nbs if nb.pos != self.last]
+            nb = random.choice(nbs)
         self.last = p.pos
-        nb = random.choice(nbs)
+        return self.waypoint_to(nb)
+
+    def waypoint_to(self, nb):
+        ''' a point on the neighbouring path element nb, straight ahead of the guest '''
         if nb.ptype < path_graph.TYPE_POI_XU:
             frac = random.uniform(0.2, 0.8)
         elif nb.ptype in (path_graph.TYPE_POI_XU, path_graph.TYPE_POI_YU):
             frac = 0.9
         else:
             frac = 0.1
-        if nb.pos[0] == X:
+        if nb.pos[0] == floor(self.x):
             return self.x, nb.pos[1] + frac
         else:
-            assert nb.pos[1] == Y
+            assert nb.pos[1] == floor(self.y)
             return nb.pos[0] + frac, self.y
 
-    def update(self, t, dt):
-        if self.action == 'wait':
-            if t >= self.action_started + 1.0:
-                self.target = None
-                self.next_waypoint = None
-                self.last = None
-
-                self.action = 'walk'
-                self.action_started = t
-
-
-        elif self.action == 'walk':
-            if self.next_waypoint is None:
-                if (floor(self.x), floor(self.y), 0) == self.simu.map_entrance:
-                    # walked out, quit
-                    self.simu.persons.remove(self)
-                else:
-                    self.next_waypoint = self.get_next_waypoint()
-
-            if self.next_waypoint is None:
-                self.action = 'wait'
-                self.action_started = t
-                return None
-
-            if self.next_waypoint[0] < self.x:
-                self.x -= self.speed * dt
-                self.x = max(self.x, self.next_waypoint[0])
-            elif self.next_waypoint[0] > self.x:
-                self.x += self.speed * dt
-                self.x = min(self.x, self.next_waypoint[0])
-            elif self.next_waypoint[1] < self.y:
-                self.y -= self.speed * dt
-                self.y = max(self.y, self.next_waypoint[1])
-            elif self.next_waypoint[1] > self.y:
-                self.y += self.speed * dt
-                self.y = min(self.y, self.next_waypoint[1])
-            else:
-                self.next_waypoint = None
-        self.update_pose()
-
-    def update_pose(self):
-        if self.action == 'wait' or self.next_waypoint is None:
-            self.pose = 'stand'
-        elif self.action == 'walk':
-            self.pose = 'walk'
-            if self.next_waypoint[0] < self.x:
-                self.direction = 180
-            elif self.next_waypoint[0] > self.x:
-                self.direction = 0
-            elif self.next_waypoint[1] < self.y:
-                self.direction = 270
-            elif self.next_waypoint[1] > self.y:
-                self.direction = 90
-        else:
-            assert False, 'unknown action ' + self.action
-
-
     def serialize(self):
         return {'name': self.name,
                 'pos': (self.x, self.y),
+                't': self.arrival_time,
+                'pal': self.palette,
                 'action': self.action,
                 'action_started': self.action_started,
                 'target': self.target,
@@ -168,12 +224,12 @@ class Person:
 
     @staticmethod
     def deserialize(simu, data):
-        self = Person(simu, data['name'], data['pos'][0], data['pos'][1], data['t'], data['pal'])
+        # the save games of older versions have no arrival time and palette
+        self = Person(simu, data['name'], data['pos'][0], data['pos'][1], data.get('t', simu.time), data.get('pal', 0))
         self.action = data['action']
         self.action_started = data['action_started']
         self.target = data['target']
-        self.waypoints = data['next_waypoint']
-        self.update_pose()
+        self.next_waypoint = data['next_waypoint']
         return self
 
 
@@ -191,10 +247,20 @@ class Simulation:
         self.world_height = world_height
         self.map = [[Tile(Terrain.GRASS, row, col)
                      for row in range(world_height)] for col in range(world_width)]
+        # connection bitfield of the path on every tile, -1 where there is no path
+        self.path_map = np.full((world_width, world_height), -1, np.int8)
+        # map_dirty requests a rebuild of the whole map, dirty_tiles holds the (column, row)
+        # of the tiles whose path changed since the renderer last updated the map
         self.map_dirty = True
+        self.dirty_tiles = set()
+        # incremented on every change of the paths or the scenery
+        self.edit_version = 0
         self.path_graph = path_graph.PathGraph()
 
-        self.persons = []
+        self.guests = guests.GuestStore()
+        self.guest_tiles = guests.TileIndex(self.guests, world_width, world_height)
+        # heap of the (time, guest serial, slot) at which guests change their state
+        self.events = []
         self.scene = []
         self.voxel = {}
         self.time = 0
@@ -216,26 +282,70 @@ class Simulation:
             delpos = [pos for pos, ob in self.voxel.items() if ob is obj]
             for pos in delpos:
                 del self.voxel[pos]
+            self.edit_version += 1
         self.set_path(x, y, False)
 
+    def restore_scene(self, scene):
+        ''' replace the scene objects by the serialized objects in scene '''
+        if scene == [element.serialize() for element in self.scene]:
+            return
+        for element in list(self.scene):
+            self.remove_scenery(element.x, element.y, 0)
+        for data in scene:
+            if data['type'] == 'shop':
+                self.add_shop(data['x'], data['y'])
+            elif data['type'] == 'entrance':
+                self.add_entrance(data['x'], data['y'])
+            else:
+                raise Exception('unknown scene object {!r}'.format(data['type']))
+
     def set_path(self, column, row, path):
-        self.map_dirty = True
         pos = (column, row, 0)
         if path:
             if pos in self.path_graph.path:
                 return
             self.path_graph.add_path_element((column, row, 0), path_graph.TYPE_FLAT)
-            self.map[column][row].path = self.path_graph.path[(column, row, 0)].connection_bitfield
+            self.set_tile_path(column, row, self.path_graph.path[(column, row, 0)].connection_bitfield)
             neighbours = self.path_graph.path[pos].neighbours
         else:
             if pos not in self.path_graph.path:
                 return
             neighbours = self.path_graph.path[pos].neighbours
-            self.map[column][row].path = None
+            self.set_tile_path(column, row, None)
             self.path_graph.remove_path_element((column, row, 0))
         for nb in neighbours:
             if nb.ptype < path_graph.TYPE_POI_XU:
-                self.map[nb.pos[0]][nb.pos[1]].path = nb.connection_bitfield
+                self.set_tile_path(nb.pos[0], nb.pos[1], nb.connection_bitfield)
+
+    def add_paths(self, tiles):
+        '''
+        Lay paths on all the (column, row) tiles at once.
+
+        The path graph is built in bulk mode, so the distances to the points of
+        interest are computed once at the end instead of after every tile.
+        '''
+        added = []
+        with self.path_graph.bulk():
+            for column, row in tiles:
+                pos = (column, row, 0)
+                if pos not in self.path_graph.path:
+                    self.path_graph.add_path_element(pos, path_graph.TYPE_FLAT)
+                    added.append(self.path_graph.node_ids[pos])
+        graph = self.path_graph
+        added = np.asarray(added, np.int64)
+        nodes = graph.neighbour[added]
+        nodes = np.union1d(added, nodes[nodes >= 0])
+        nodes = nodes[graph.ptype[nodes] < path_graph.TYPE_POI_XU]
+        for (column, row, _), path in zip(graph.position[nodes].tolist(), graph.connection_bitfield[nodes].tolist()):
+            self.set_tile_path(column, row, path)
+
+    def set_tile_path(self, column, row, path):
+        self.map[column][row].path = path
+        value = -1 if path is None else path
+        if self.path_map[column, row] != value:
+            self.path_map[column, row] = value
+            self.dirty_tiles.add((column, row))
+            self.edit_version += 1
 
     def update(self, delta_sim_seconds):
         self.time += delta_sim_seconds
@@ -248,10 +358,71 @@ class Simulation:
                 pers.next_waypoint = (self.map_entrance[0] + dx, random.uniform(0.2, 0.8))
                 pers.action = 'walk'
                 pers.last = self.map_entrance
-                self.persons.append(pers)
+                pers.target = self.choose_target(None)
 
-            for person in self.persons:
-                person.update(self.time, delta_sim_seconds)
+            self.update_guests(self.time)
+            self.guest_tiles.advance(self.time)
+
+    def schedule(self, slot, t=None):
+        '''
+        Schedule the next event of the guest in slot from its current state.
+
+        t is the current time, by default the simulation time. Events scheduled
+        earlier for the guest are dropped when they come up.
+        '''
+        if t is None:
+            t = self.time
+        store = self.guests
+        wake = store.wake_at(slot, t)
+        store.wake_time[slot] = wake
+        heapq.heappush(self.events, (wake, store.serial[slot].item(), slot))
+        self.guest_tiles.update(slot, t)
+
+    def update_guests(self, t):
+        ''' handle all guest events up to time t, guests without an event are not touched '''
+        store = self.guests
+        events = self.events
+        while events and events[0][0] <= t:
+            wake, serial, slot = heapq.heappop(events)
+            if not store.alive[slot] or store.serial[slot] != serial or store.wake_time[slot] != wake:
+                continue  # the guest left or was rescheduled
+            self.wake(slot, wake)
+
+    def wake(self, slot, t):
+        ''' the guest in slot finished waiting or arrived at its waypoint at time t '''
+        store = self.guests
+        if store.action[slot] == guests.ACTION_WAIT:
+            store.action[slot] = guests.ACTION_WALK
+            store.action_started[slot] = t
+            store.has_last[slot] = False
+        elif not isnan(store.waypoint_x[slot]):
+            store.x[slot] = store.waypoint_x[slot]
+            store.y[slot] = store.waypoint_y[slot]
+        store.waypoint_x[slot] = store.waypoint_y[slot] = float('nan')
+        store.depart_time[slot] = t
+
+        if (floor(store.x[slot]), floor(store.y[slot]), 0) == self.map_entrance:
+            # walked out, quit
+            self.guest_tiles.remove(slot)
+            store.remove(slot)
+            return
+        waypoint = store.views[slot].get_next_waypoint()
+        if waypoint is None:
+            store.action[slot] = guests.ACTION_WAIT
+            store.action_started[slot] = t
+        else:
+            store.waypoint_x[slot], store.waypoint_y[slot] = waypoint
+        self.schedule(slot, t)
+
+    def choose_target(self, visited):
+        ''' the next target of a guest who just visited the target visited, None for new guests '''
+        if visited is None:
+            return 'shop'
+        return 'MapEntrance'
+
+    @property
+    def persons(self):
+        return list(self.guests)
 
     def current_datetime(self):
         return get_datetime(self.time)
@@ -259,9 +430,10 @@ class Simulation:
     def add_shop(self, x, y):
         shop = Object(x=x, y=y, name='Shop', direction=180, type='shop')
         self.scene.append(shop)
-        self.path_graph.add_path_element((x, y, 0), path_graph.TYPE_POI_XD, shop)
+        self.path_graph.add_path_element((x, y, 0), path_graph.TYPE_POI_XD, shop, category='shop')
         self.voxel[x, y, 0] = shop
         self.voxel[x, y, 1] = shop
+        self.edit_version += 1
 
     def add_entrance(self, x, y):
         entr = Object(x=x, y=y, direction=90, type='entrance', name='Park Entrance')
@@ -269,6 +441,7 @@ class Simulation:
         self.path_graph.add_path_element((x, y, 0), path_graph.TYPE_FLAT, entr)
         self.voxel[x, y, 0] = entr
         self.voxel[x, y, 1] = entr
+        self.edit_version += 1
 
     def serialize(self):
         return {'world_width': self.world_width,
@@ -281,15 +454,48 @@ class Simulation:
     @staticmethod
     def deserialize(data):
         self = Simulation(data['world_width'], data['world_height'])
+        self.restore_scene(data['scene'])
         self.map = [[Tile.deserialize(col, row, tile_data) for row, tile_data in enumerate(col_data)] for col, col_data in enumerate(data['map'])]
-        for column in self.map:
-            for tile in column:
-                if tile.path is not None:
-                    self.set_path(tile.column, tile.row, True)
+        self.add_paths((tile.column, tile.row) for column in self.map for tile in column if tile.path is not None)
 
-        self.persons = [Person.deserialize(self, pers) for pers in data['persons']]
         self.time = data['time']
+        for pers in data['persons']:
+            Person.deserialize(self, pers)
+        self.guests.update_poses(self.time)
         return self
 
 
-
+def test():
+    def assert_eq(a, b):
+        assert a == b, '%s != %s' % (a, b)
+
+    simulation = Simulation(8, 8)
+    store = simulation.guests
+    woken = []
+    simulation.wake = lambda slot, t: woken.append((round(t, 6), store.views[slot].name))
+    a, b, c, d = [Person(simulation, name, 5.5, 0.5, 0.0, 0) for name in 'ABCD']
+
+    # rescheduled guests only wake at their latest event
+    a.action_started = 0.5
+    simulation.schedule(a.slot)
+    store.action[c.slot] = guests.ACTION_WALK
+    store.waypoint_x[c.slot], store.waypoint_y[c.slot] = 5.5, 0.5 + 0.9
+    simulation.schedule(c.slot)
+
+    # the events of a removed guest are dropped, also if its slot is reused
+    store.remove(d.slot)
+    e = Person(simulation, 'E', 5.5, 0.5, 0.0, 0)
+    assert_eq(e.slot, d.slot)
+    e.action_started = 0.25
+    simulation.schedule(e.slot)
+
+    # the events come in the order of their times
+    simulation.update_guests(1.0)
+    assert_eq(woken, [(1.0, 'B')])
+    simulation.update_guests(10.0)
+    assert_eq(woken, [(1.0, 'B'), (1.25, 'E'), (1.5, 'A'), (2.0, 'C')])
+    assert_eq(simulation.events, [])
+
+
+if __name__ == '__main__':
+    test()
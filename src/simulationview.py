@@ -4,7 +4,7 @@ Created on 8 Jul 2015
 @author: leonhard
 '''
 import logging
-from ctypes import pointer, sizeof
+from ctypes import POINTER, pointer, sizeof
 from pyglet import gl
 from pyglet.window import mouse, key
 import os
@@ -13,10 +13,13 @@ import configparser
 import shaders
 import graphix
 from graphix import GlProgram
+from clock import FixedStepClock
 from windowmanager import Label
 
 import ctypes
-import itertools
+import numpy as np
+import guests
+from pyglet.gl import gl_info
 class VERTEX(ctypes.Structure):
     _fields_ = [
         ('position', gl.GLfloat * 4),
@@ -24,6 +27,11 @@ class VERTEX(ctypes.Structure):
         ('object_id', gl.GLint),
     ]
 
+# per instance data of shaders.vertex_sprite_instanced
+INSTANCE = np.dtype([('position', np.float32, 4),
+                     ('frames', np.float32, 4),
+                     ('key', np.int32)])
+
 from graphix import make_texture
 import math
 from collections import defaultdict
@@ -38,6 +46,16 @@ TEXTURE_HEIGHT = 256
 MOUSE_SCROLL_BORDER_WIDTH = 20
 MOUSE_SCROLL_SPEED = 150
 
+CHUNK_SIZE = 16  # width and height of the map chunks in tiles
+SPRITE_MARGIN = 4 * VOXEL_HEIGHT  # sprites are culled if their position is this many pixels outside the view
+
+# in turbo mode this fraction of the time between two updates is spent simulating,
+# but at most TURBO_MAX_BUDGET seconds, and the scene is only rendered every
+# TURBO_RENDER_INTERVAL frames
+TURBO_LOAD = 0.8
+TURBO_MAX_BUDGET = 0.05
+TURBO_RENDER_INTERVAL = 10
+
 DAY_NAMES = ['1', '8', '15', '22']
 MONTH_NAMES = ['Mar', 'Apr', 'May', 'Jun',
                'Jul', 'Aug', 'Sep', 'Oct']
@@ -91,6 +109,12 @@ def zbuffer(x, y, z, mode, sub=None):
 
     return (sub + 0x20 * mode + 0x100 * mapz + 0x10000 * mapxy) / 0x1000000
 
+def zbuffer_array(x, y, z, mode, sub=0):
+    ''' zbuffer for numpy arrays of integer tile positions x, y, z '''
+    mapxy = x + y
+    assert 0 <= mapxy.min() and mapxy.max() < 256
+    return ((sub + 0x20 * mode + 0x100 * z + 0x10000 * mapxy) / 0x1000000).astype(np.float32)
+
 
 def decode_zbuffer(value):
     value = int(value * 0x1000000 + 0.5)
@@ -136,23 +160,66 @@ class tileset:
 
 
 import weakref
+
+# the picking buffer is GL_R16UI, key 0 means no object
+MAX_KEY = 65535
+
 class Mapper:
-    def __init__(self):
-        self.obj_to_key = weakref.WeakKeyDictionary({self:0})
-        self.key_to_obj = weakref.WeakValueDictionary({0:self})
+    '''
+    Assigns the keys written to the picking buffer to objects.
+
+    Objects are referenced weakly, the key of a garbage collected object
+    goes back to a free list and is reused. If all keys up to max_key are in
+    use, key() returns 0, so the object is drawn but cannot be picked. The
+    objects refused a key are counted once each in overflows, the first
+    overflow is logged. released counts the returned keys, callers holding
+    refused objects only need to ask again when it changed.
+    '''
+    def __init__(self, max_key=MAX_KEY):
+        self.obj_to_key = weakref.WeakKeyDictionary()
+        self.key_to_obj = {}  # key -> weak reference to the object
+        self.free = []
+        self.next_key = 1
+        self.max_key = max_key
+        self.overflows = 0
+        self.refused = weakref.WeakSet()
+        self.released = 0
+
+    def __len__(self):
+        return len(self.key_to_obj)
 
     def key(self, obj):
-        if obj in self.obj_to_key:
-            return self.obj_to_key[obj]
-        newkey = next(x for x in itertools.count() if x not in self.key_to_obj)
-        self.obj_to_key[obj] = newkey
-        self.key_to_obj[newkey] = obj
-        return newkey
+        key = self.obj_to_key.get(obj)
+        if key is not None:
+            return key
+        if self.free:
+            key = self.free.pop()
+        elif self.next_key <= self.max_key:
+            key = self.next_key
+            self.next_key += 1
+        else:
+            if obj not in self.refused:
+                if not self.overflows:
+                    logging.warning('All {} picking keys are in use, new objects cannot be picked'.format(self.max_key))
+                self.overflows += 1
+                self.refused.add(obj)
+            return 0
+        self.refused.discard(obj)
+        self.obj_to_key[obj] = key
+        self.key_to_obj[key] = weakref.ref(obj, lambda _, key=key: self.release(key))
+        return key
+
+    def release(self, key):
+        ''' the object of key was collected '''
+        del self.key_to_obj[key]
+        self.free.append(key)
+        self.released += 1
 
     def obj(self, key):
-        if key == 0:
+        ref = self.key_to_obj.get(key)
+        if ref is None:
             return None
-        return self.key_to_obj.get(key, None)
+        return ref()
 
 class SimulationView:
     '''
@@ -166,6 +233,8 @@ class SimulationView:
         '''
         self.wm = wm
         self.simulation = None
+        self.clock = None
+        self.frames_since_render = 0
         self.orientation = 0
         self.screen_origin_x = 0
         self.screen_origin_y = 0
@@ -174,7 +243,6 @@ class SimulationView:
         self.pixel_size = 2
         self.speed = 1.0
 
-        self.pers = defaultdict(list)
         self.scenery = defaultdict(list)
 
         self.sprite_pers = Sprite('../art/guest.ini')
@@ -182,24 +250,62 @@ class SimulationView:
         self.sprite_entrance = Sprite('../art/entrance.ini')
 
         self.tiles = tileset('../art/map.ini')
-        self.map_data_length = None
+        self.map_vertices = None
         self.init_gl()
         self.mapper = Mapper()
         self.mouse_object_key = None
+        self.mouse_pos_world = None
+        # the (mouse position, screen origin, edit version and guests under the mouse) of the last picking request
+        self.picking_state = None
+        # picking keys of the guests by slot and the serial number of the guest the key belongs to
+        self.guest_key = np.zeros(0, np.int32)
+        self.guest_key_serial = np.zeros(0, np.int64)
+        self.guest_key_released = 0
 
 
     def init_gl(self):
         self.framebuffer = graphix.Framebuffer()
+        self.picker = graphix.PixelReader()
         self.program = GlProgram(shaders.vertex_scene, shaders.fragment_scene)
         self.sprite_program = GlProgram(shaders.vertex_scene, shaders.fragment_sprite)
         gl.glBindFragDataLocation(self.sprite_program.handle, 0, b'FragColor')
         gl.glBindFragDataLocation(self.sprite_program.handle, 1, b'ObjectID')
 
-        self.buffer = gl.GLuint(0)
+        self.instancing = gl_info.have_version(3, 3) or gl_info.have_extension('GL_ARB_instanced_arrays')
+        if self.instancing:
+            self.instanced_program = GlProgram(shaders.vertex_sprite_instanced, shaders.fragment_sprite)
+            gl.glBindFragDataLocation(self.instanced_program.handle, 0, b'FragColor')
+            gl.glBindFragDataLocation(self.instanced_program.handle, 1, b'ObjectID')
+            # the vertex array records offset 0 of the instance data, so every frame orphans the buffer
+            self.instance_stream = graphix.StreamBuffer(segments=1)
+        else:
+            logging.info('Instanced arrays are not supported, guests are drawn vertex by vertex.')
+
+        self.sprite_stream = graphix.StreamBuffer()
         self.map_buffer = gl.GLuint(0)
-        gl.glGenBuffers(1, pointer(self.buffer))
         gl.glGenBuffers(1, pointer(self.map_buffer))
 
+        # the vertex layouts of the map, the sprites drawn vertex by vertex and the instanced guests
+        self.map_vertex_array = graphix.VertexArray()
+        with self.map_vertex_array:
+            self.program.vertex_attrib_pointer(self.map_buffer, b"position", 4, stride=8 * sizeof(gl.GLfloat))
+            self.program.vertex_attrib_pointer(self.map_buffer, b"texcoord", 4, stride=8 * sizeof(gl.GLfloat), offset=4 * sizeof(gl.GLfloat))
+        self.sprite_vertex_array = graphix.VertexArray()
+        with self.sprite_vertex_array:
+            self.sprite_program.vertex_attrib_pointer(self.sprite_stream.handle, b"position", 4, stride=sizeof(VERTEX), offset=VERTEX.position.offset)
+            self.sprite_program.vertex_attrib_pointer(self.sprite_stream.handle, b"texcoord", 4, stride=sizeof(VERTEX), offset=VERTEX.texcoord.offset)
+            self.sprite_program.vertex_attrib_pointer(self.sprite_stream.handle, b"object_id", 1, stride=sizeof(VERTEX), offset=VERTEX.object_id.offset)
+        if self.instancing:
+            self.guest_vertex_array = graphix.VertexArray()
+            with self.guest_vertex_array:
+                program = self.instanced_program
+                program.vertex_attrib_pointer(self.instance_stream.handle, b"instance_position", 4, stride=INSTANCE.itemsize,
+                                              offset=INSTANCE.fields['position'][1], divisor=1)
+                program.vertex_attrib_pointer(self.instance_stream.handle, b"instance_frames", 4, stride=INSTANCE.itemsize,
+                                              offset=INSTANCE.fields['frames'][1], divisor=1)
+                program.vertex_attrib_pointer(self.instance_stream.handle, b"instance_key", 1, type=gl.GL_INT, stride=INSTANCE.itemsize,
+                                              offset=INSTANCE.fields['key'][1], divisor=1, integer=True)
+
         gl.glEnable(gl.GL_BLEND)
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
 
@@ -209,16 +315,25 @@ class SimulationView:
     def load(self, simulation):
         assert self.simulation is None
         self.simulation = simulation
-        self.label = Label(self.wm.root, '', 0, 0)
+        self.clock = FixedStepClock(simulation)
+        self.label = Label(self.wm.root, '', 0, 0, glyphs=True)
         self.scroll_to(self.screen_width // 2, self.screen_height)
 
     def unload(self):
         self.simulation = None
+        self.clock = None
+        self.map_vertices = None
         self.wm.root.close()
 
     def update(self, dt):
         if self.simulation:
-            self.simulation.update(dt * self.speed)
+            if self.clock.turbo:
+                # turbo mode simulates as fast as the budget allows, so the speed
+                # multiplier does not apply, only speed 0 pauses it too
+                if self.speed > 0:
+                    self.clock.run_for(min(TURBO_LOAD * dt, TURBO_MAX_BUDGET))
+            else:
+                self.clock.advance(dt * self.speed)
         if 0 <= self.mouse_x < MOUSE_SCROLL_BORDER_WIDTH:
             self.scroll(dt * MOUSE_SCROLL_SPEED, 0)
         if self.screen_width - MOUSE_SCROLL_BORDER_WIDTH <= self.mouse_x < self.screen_width:
@@ -229,44 +344,120 @@ class SimulationView:
             self.scroll(0, dt * MOUSE_SCROLL_SPEED)
 
 
-    def get_map_vertex_data(self):
-        floor = self.tiles.tiles['Grass']
-        points = [(0, 0), (1, 0), (1, 1), (0, 1)]
-
-        pathtiles = {p:self.tiles.tiles['Road%d' % p] for p in range(16)}
-        pathtiles[None] = [(0, 0), (0, 0), (0, 0), (0, 0)]
+    def init_map_vertex_data(self):
+        '''
+        Precompute the parts of the map mesh which do not depend on the paths.
 
-        z = 0.0
+        The mesh has 4 vertices for every tile. Each vertex consists of 8 floats:
+        position x, y, z, zbuffer, texture coordinates u, v of the ground and
+        s, t of the path.
 
-        for x, row in enumerate(self.simulation.map):
-            for y, tile in enumerate(row):
-                zbuf = zbuffer(x, y, z, ZMODE_BOTTOM)
-                for (dx, dy), (u, v), (s, t) in zip(points, floor, pathtiles[tile.path]):
-                    yield from (x + dx, y + dy, z, zbuf,
-                                u, v, s, t)
+        The map is split into chunks of CHUNK_SIZE x CHUNK_SIZE tiles. The
+        vertices of a chunk are a contiguous range of the vertex buffer, ordered
+        by column and row, so a chunk can be updated and drawn on its own.
+        '''
+        width = self.simulation.world_width
+        height = self.simulation.world_height
+        points = np.array([(0, 0), (1, 0), (1, 1), (0, 1)], np.float32)
+        x, y = np.meshgrid(np.arange(width), np.arange(height), indexing='ij')
+
+        data = np.zeros((width, height, 4, 8), np.float32)
+        data[..., 0] = x[..., None] + points[:, 0]
+        data[..., 1] = y[..., None] + points[:, 1]
+        data[..., 3] = zbuffer_array(x, y, 0, ZMODE_BOTTOM)[..., None]
+        data[..., 4:6] = self.tiles.tiles['Grass']
+        self.map_vertices = data
+
+        # tile bounds (x0, y0, x1, y1), first vertex and number of vertices of every chunk
+        self.chunk_bounds = np.array([(x0, y0, min(x0 + CHUNK_SIZE, width), min(y0 + CHUNK_SIZE, height))
+                                      for x0 in range(0, width, CHUNK_SIZE)
+                                      for y0 in range(0, height, CHUNK_SIZE)], np.int32).reshape(-1, 4)
+        self.chunk_count = 4 * (self.chunk_bounds[:, 2] - self.chunk_bounds[:, 0]) * (self.chunk_bounds[:, 3] - self.chunk_bounds[:, 1])
+        self.chunk_first = np.concatenate([[0], np.cumsum(self.chunk_count)[:-1]]).astype(np.int32)
+        chunks_per_column = -(-height // CHUNK_SIZE)
+        self.tile_chunk = (x // CHUNK_SIZE) * chunks_per_column + y // CHUNK_SIZE
+
+        # texture coordinates for each connection bitfield, the last entry is for tiles without path
+        self.path_texcoords = np.zeros((17, 4, 2), np.float32)
+        for p in range(16):
+            self.path_texcoords[p] = self.tiles.tiles['Road%d' % p]
 
+    def get_map_vertex_data(self):
+        ''' the map mesh of all chunks as a float32 array with one row per vertex '''
+        if self.map_vertices is None or self.map_vertices.shape[:2] != self.simulation.path_map.shape:
+            self.init_map_vertex_data()
+        self.map_vertices[..., 6:8] = self.path_texcoords[self.simulation.path_map]
+        return np.concatenate([self.map_vertices[x0:x1, y0:y1].reshape(-1, 8) for x0, y0, x1, y1 in self.chunk_bounds])
+
+    def get_chunk_vertex_data(self, chunk):
+        ''' update the path texture coordinates of one chunk, returns its vertices '''
+        x0, y0, x1, y1 = self.chunk_bounds[chunk]
+        vertices = self.map_vertices[x0:x1, y0:y1]
+        vertices[..., 6:8] = self.path_texcoords[self.simulation.path_map[x0:x1, y0:y1]]
+        return vertices.reshape(-1, 8)
+
+    def screen_position(self, x, y, z=0):
+        ''' the framebuffer pixel coordinates of the world coordinates x, y, z as computed by the vertex shaders '''
+        screen_x = VOXEL_X_SIDE * (x - y) + self.screen_origin_x // self.pixel_size
+        screen_y = VOXEL_Y_SIDE * (x + y) + VOXEL_HEIGHT * z - self.screen_origin_y // self.pixel_size
+        return screen_x, screen_y
+
+    def in_view(self, x, y, margin=SPRITE_MARGIN):
+        ''' boolean mask of the world coordinates x, y which are at most margin pixels outside the viewport '''
+        screen_x, screen_y = self.screen_position(x, y)
+        return ((-margin <= screen_x) & (screen_x <= self.fbo_width + margin) &
+                (-self.fbo_height - margin <= screen_y) & (screen_y <= margin))
+
+    def screen_tiles(self, screen_x0, screen_y0, screen_x1, screen_y1):
+        ''' the (column0, row0, column1, row1) of the tiles which cover the rect from screen_x0, screen_y0 to screen_x1, screen_y1 '''
+        screen_x = np.array([screen_x0, screen_x1, screen_x0, screen_x1])
+        screen_y = np.array([screen_y0, screen_y0, screen_y1, screen_y1])
+        # invert screen_position for the corners of the rect
+        x_minus_y = (screen_x - self.screen_origin_x // self.pixel_size) / VOXEL_X_SIDE
+        x_plus_y = (screen_y + self.screen_origin_y // self.pixel_size) / VOXEL_Y_SIDE
+        x = (x_plus_y + x_minus_y) / 2
+        y = (x_plus_y - x_minus_y) / 2
+        return math.floor(x.min()), math.floor(y.min()), math.floor(x.max()), math.floor(y.max())
+
+    def visible_tiles(self, margin=SPRITE_MARGIN):
+        ''' the (column0, row0, column1, row1) of the tiles which are at most margin pixels outside the viewport '''
+        return self.screen_tiles(-margin, -self.fbo_height - margin, self.fbo_width + margin, margin)
+
+    def visible_chunks(self):
+        ''' the indices of the chunks which intersect the viewport '''
+        x0, y0, x1, y1 = self.chunk_bounds.T
+        left = self.screen_position(x0, y1)[0]
+        right = self.screen_position(x1, y0)[0]
+        bottom = self.screen_position(x0, y0)[1]
+        top = self.screen_position(x1, y1)[1]
+        return np.flatnonzero((right >= 0) & (left <= self.fbo_width) & (top >= -self.fbo_height) & (bottom <= 0))
 
     def get_sprite_vertex_data(self, sprite, objects):
         for i, obj in enumerate(objects):
-            yield from sprite.vertex_data(self.simulation.time, **obj.__dict__)
+            yield from sprite.vertex_data(self.clock.render_time, **obj.__dict__)
 
     def set_mouse_pos_world(self):
-        depth = ctypes.c_float(0.0)
-        color = (ctypes.c_float * 3)(0.0)
-        objectid = gl.GLint(0)
-
-        gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT0)
-        gl.glReadPixels(self.mouse_x // self.pixel_size, self.mouse_y // self.pixel_size, 1, 1, gl.GL_DEPTH_COMPONENT, gl.GL_FLOAT, pointer(depth))  # print(depth, decode_zbuffer(depth.value * 2 - 1))
-        gl.glReadPixels(self.mouse_x // self.pixel_size, self.mouse_y // self.pixel_size, 1, 1, gl.GL_RGB, gl.GL_FLOAT, color)
-        gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT1)
-        gl.glReadPixels(self.mouse_x // self.pixel_size, self.mouse_y // self.pixel_size, 1, 1, gl.GL_RED_INTEGER, gl.GL_INT, pointer(objectid))
-
-        self.mouse_object_key = objectid.value
+        '''
+        Update mouse_object_key and mouse_pos_world from the picking buffers.
 
-        # print ('%0.5f' % (depth.value), tuple(int(x * 255 + 0.5) for x in color), objectid)
+        The pixels under the mouse are read asynchronously, the result arrives
+        a few frames later. Nothing is read while the mouse, the view, the
+        scene and the guests drawn under the mouse stay the same.
+        '''
+        x = self.mouse_x // self.pixel_size
+        y = self.mouse_y // self.pixel_size
+        state = (x, y, self.screen_origin_x, self.screen_origin_y, self.simulation.edit_version, self.get_guests_at(x, y))
+        if state != self.picking_state:
+            self.picking_state = state
+            self.picker.request(x, y, tag=state)
+
+        result = self.picker.resolve()
+        if result is None:
+            return
+        depth, self.mouse_object_key, (x, _, screen_origin_x, _, _, _) = result
 
-        xmy = math.floor((self.mouse_x // self.pixel_size - self.screen_origin_x // self.pixel_size) / VOXEL_X_SIDE)
-        xpy, Z, mode, sub = decode_zbuffer(depth.value * 2 - 1)
+        xmy = math.floor((x - screen_origin_x // self.pixel_size) / VOXEL_X_SIDE)
+        xpy, Z, mode, sub = decode_zbuffer(depth * 2 - 1)
         if (xmy + xpy) % 2 == 0:
             X = (xmy + xpy) // 2
             Y = (xpy - xmy) // 2
@@ -276,27 +467,52 @@ class SimulationView:
         self.mouse_pos_world = X, Y, Z, mode, sub
 
 
+    def get_guests_at(self, x, y):
+        '''
+        The slot, serial, pixel position, pose and direction of the guests
+        whose sprite covers the framebuffer pixel x, y, as a tuple of tuples.
+        '''
+        store = self.simulation.guests
+        sprite = self.sprite_pers
+        # the rect of the sprite positions for which the sprite covers the pixel, see Sprite.vertex_data
+        screen_y = y - self.fbo_height
+        left, right = x - sprite.offset_x - 1, x + sprite.offset_x + 1
+        bottom, top = screen_y - sprite.offset_y - 1, screen_y - sprite.offset_y + sprite.frame_height + 1
+        # one tile more covers the guests which changed their tile since the render time
+        column0, row0, column1, row1 = self.screen_tiles(left, bottom, right, top)
+        slots = np.sort(self.simulation.guest_tiles.in_rect(column0 - 1, row0 - 1, column1 + 1, row1 + 1))
+        screen_x, screen_y = self.screen_position(*store.positions(slots, self.clock.render_time))
+        screen_x, screen_y = np.floor(screen_x), np.floor(screen_y)
+        covers = (left <= screen_x) & (screen_x <= right) & (bottom <= screen_y) & (screen_y <= top)
+        slots = slots[covers]
+        return tuple(zip(slots.tolist(), store.serial[slots].tolist(),
+                         screen_x[covers].tolist(), screen_y[covers].tolist(),
+                         store.pose[slots].tolist(), store.direction[slots].tolist()))
+
     def draw(self):
         if self.simulation is None:
             return
+        now = self.simulation.current_datetime()
+        self.label.text = 'Simulated date is {} + {:0.1f}'.format(format_date(now), now[3])
+        self.frames_since_render += 1
+        if self.clock.turbo and self.frames_since_render < TURBO_RENDER_INTERVAL:
+            # show the last rendered state again
+            gl.glViewport(0, 0, self.screen_width, self.screen_height)
+            self.framebuffer.copy()
+            return
+        self.frames_since_render = 0
+
         self.framebuffer.bind()
         self.framebuffer.clear()
         gl.glEnable(gl.GL_DEPTH_TEST)
         gl.glViewport(0, 0, self.fbo_width, self.fbo_height)
-        now = self.simulation.current_datetime()
-        self.label.text = 'Simulated date is {} + {:0.1f}'.format(format_date(now), now[3])
 
         self.program.use()
-        self.program.vertex_attrib_pointer(self.map_buffer, b"position", 4, stride=8 * sizeof(gl.GLfloat))
-        self.program.vertex_attrib_pointer(self.map_buffer, b"texcoord", 4, stride=8 * sizeof(gl.GLfloat), offset=4 * sizeof(gl.GLfloat))
-
+        self.map_vertex_array.bind()
         self.draw_map()
 
         self.sprite_program.use()
-        self.sprite_program.vertex_attrib_pointer(self.buffer, b"position", 4, stride=sizeof(VERTEX), offset=VERTEX.position.offset)
-        self.sprite_program.vertex_attrib_pointer(self.buffer, b"texcoord", 4, stride=sizeof(VERTEX), offset=VERTEX.texcoord.offset)
-        self.sprite_program.vertex_attrib_pointer(self.buffer, b"object_id", 1, stride=sizeof(VERTEX), offset=VERTEX.object_id.offset)
-
+        self.sprite_vertex_array.bind()
         self.draw_scene()
         self.draw_persons()
 
@@ -315,45 +531,123 @@ class SimulationView:
 
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.map_buffer)
         if self.simulation.map_dirty:
-            data = list(self.get_map_vertex_data())
-            data = (gl.GLfloat * len(data))(*data)
+            data = self.get_map_vertex_data()
             self.simulation.map_dirty = False
-            gl.glBufferData(gl.GL_ARRAY_BUFFER, sizeof(data), data, gl.GL_DYNAMIC_DRAW)
-            self.map_data_length = len(data) // 8
-
-        gl.glDrawArrays(gl.GL_QUADS, 0, self.map_data_length)
+            self.simulation.dirty_tiles.clear()
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data, gl.GL_DYNAMIC_DRAW)
+        elif self.simulation.dirty_tiles:
+            # only upload the chunks containing tiles that changed
+            for chunk in {self.tile_chunk[tile] for tile in self.simulation.dirty_tiles}:
+                data = self.get_chunk_vertex_data(chunk)
+                gl.glBufferSubData(gl.GL_ARRAY_BUFFER, int(self.chunk_first[chunk]) * 8 * sizeof(gl.GLfloat), data.nbytes, data.ctypes.data)
+            self.simulation.dirty_tiles.clear()
+
+        visible = self.visible_chunks()
+        if len(visible):
+            first = np.ascontiguousarray(self.chunk_first[visible], np.int32)
+            count = np.ascontiguousarray(self.chunk_count[visible], np.int32)
+            gl.glMultiDrawArrays(gl.GL_QUADS, first.ctypes.data_as(POINTER(gl.GLint)),
+                                 count.ctypes.data_as(POINTER(gl.GLsizei)), len(visible))
 
     def draw_persons(self):
+        self.simulation.guests.update_poses(self.clock.render_time)
+        if self.instancing:
+            self.draw_persons_instanced()
+        else:
+            self.draw_persons_vertices()
+
+    def get_guest_keys(self):
+        ''' the picking keys of all guest slots, keys are only looked up for new guests '''
+        store = self.simulation.guests
+        if len(self.guest_key) != store.capacity:
+            self.guest_key = np.resize(self.guest_key, store.capacity)
+            self.guest_key_serial = np.resize(self.guest_key_serial, store.capacity)
+            self.guest_key_serial[:] = 0
+        pending = store.alive & (self.guest_key_serial != store.serial)
+        if self.mapper.released != self.guest_key_released:
+            # keys were freed, the guests left without a key try again
+            self.guest_key_released = self.mapper.released
+            pending |= store.alive & (self.guest_key == 0)
+        for slot in np.flatnonzero(pending):
+            self.guest_key[slot] = self.mapper.key(store.views[slot])
+            self.guest_key_serial[slot] = store.serial[slot]
+        return self.guest_key
+
+    def get_guest_instance_data(self, sprite):
+        ''' the INSTANCE array of the guests in view '''
+        store = self.simulation.guests
+        slots = np.flatnonzero(store.alive)
+        x, y = store.positions(slots, self.clock.render_time)
+        visible = self.in_view(x, y)
+        slots = slots[visible]
+        first_frame, number_of_frames = sprite.pose_frames(guests.POSES)
+        pose = store.pose[slots]
+
+        data = np.frombuffer(self.instance_stream.staging(ctypes.c_byte, len(slots) * INSTANCE.itemsize), INSTANCE)
+        data[:] = 0
+        data['position'][:, 0] = x[visible]
+        data['position'][:, 1] = y[visible]
+        data['position'][:, 3] = store.direction[slots]
+        data['frames'][:, 0] = first_frame[pose]
+        data['frames'][:, 1] = number_of_frames[pose]
+        data['frames'][:, 2] = store.palette[slots]
+        data['key'] = self.get_guest_keys()[slots]
+        return data
+
+    def draw_persons_instanced(self):
         sprite = self.sprite_pers
+        program = self.instanced_program
+        program.use()
         gl.glActiveTexture(gl.GL_TEXTURE0)
         gl.glBindTexture(gl.GL_TEXTURE_2D, sprite.texture)
-        self.sprite_program.uniform1i(b"tex", 0)  # set to 0 because the texture is bound to GL_TEXTURE0
+        program.uniform1i(b"tex", 0)  # set to 0 because the texture is bound to GL_TEXTURE0
 
         gl.glActiveTexture(gl.GL_TEXTURE1)
         gl.glBindTexture(gl.GL_TEXTURE_2D, sprite.texture_pal)
-        self.sprite_program.uniform1i(b"palette", 1)  # set to 1 because the texture is bound to GL_TEXTURE1
+        program.uniform1i(b"palette", 1)  # set to 1 because the texture is bound to GL_TEXTURE1
+        sprite.set_uniforms(program, self.clock.render_time)
 
-        self.pers.clear()
-        for pers in self.simulation.persons:
-            self.pers[math.floor(pers.x), math.floor(pers.y)].append(pers)
+        data = self.get_guest_instance_data(sprite)
+        self.instance_stream.write(data)
+        self.guest_vertex_array.bind()
 
-        data = []
-        for lst in self.pers.values():
-            lst.sort(key=lambda pers: pers.x + pers.y)
-            for rank, pers in enumerate(lst):
-                data.extend(sprite.vertex_data(self.simulation.time, rank=rank, mode=ZMODE_SUBVOX_MIDDLE, **pers.__dict__))
+        for mode, u_offset in sprite.layers:
+            program.uniform2f(b'layer', u_offset, -1 if mode is None else mode)
+            gl.glDrawArraysInstanced(gl.GL_QUADS, 0, 4, len(data))
+
+    def draw_persons_vertices(self):
+        sprite = self.sprite_pers
+        self.sprite_program.use()
+        self.sprite_vertex_array.bind()
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, sprite.texture)
+        self.sprite_program.uniform1i(b"tex", 0)  # set to 0 because the texture is bound to GL_TEXTURE0
+
+        gl.glActiveTexture(gl.GL_TEXTURE1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, sprite.texture_pal)
+        self.sprite_program.uniform1i(b"palette", 1)  # set to 1 because the texture is bound to GL_TEXTURE1
 
+        # the tile index is at the simulation time, one tile more covers the guests
+        # which changed their tile since the render time
+        store = self.simulation.guests
+        column0, row0, column1, row1 = self.visible_tiles()
+        slots = self.simulation.guest_tiles.in_rect(column0 - 1, row0 - 1, column1 + 1, row1 + 1)
+        x, y = store.positions(slots, self.clock.render_time)
+        visible = self.in_view(x, y)
+        keys = self.get_guest_keys()
 
         data = []
-        for pers in self.simulation.persons:
-            key = self.mapper.key(pers)
-            data.extend(sprite.vertex_data(self.simulation.time, key=key, **pers.__dict__))
+        for slot, x, y in zip(slots[visible].tolist(), x[visible].tolist(), y[visible].tolist()):
+            pers = store.views[slot]
+            data.extend(sprite.vertex_data(self.clock.render_time, key=keys[slot],
+                                           x=x, y=y, direction=pers.direction,
+                                           pose=pers.pose, palette=pers.palette))
 
-        data = (VERTEX * len(data))(*data)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer)
-        gl.glBufferData(gl.GL_ARRAY_BUFFER, sizeof(data), data, gl.GL_DYNAMIC_DRAW)
+        vertices = self.sprite_stream.staging(VERTEX, len(data))
+        vertices[:] = data
+        first = self.sprite_stream.write(vertices, sizeof(VERTEX))
 
-        gl.glDrawArrays(gl.GL_QUADS, 0, len(data))
+        gl.glDrawArrays(gl.GL_QUADS, first, len(vertices))
 
     def draw_scene(self):
         sprite = self.sprite_shop
@@ -366,12 +660,13 @@ class SimulationView:
         self.sprite_program.uniform1i(b"palette", 1)  # set to 1 because the texture is bound to GL_TEXTURE1
 
         sprites = {'shop': self.sprite_shop, 'entrance': self.sprite_entrance}
-        data = list(d for obj in self.simulation.scene for d in sprites[obj.type].vertex_data(self.simulation.time, **obj.__dict__))
-        data = (VERTEX * len(data))(*data)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer)
-        gl.glBufferData(gl.GL_ARRAY_BUFFER, sizeof(data), data, gl.GL_DYNAMIC_DRAW)
+        objects = [obj for obj in self.simulation.scene if self.in_view(obj.x, obj.y)]
+        data = list(d for obj in objects for d in sprites[obj.type].vertex_data(self.clock.render_time, **obj.__dict__))
+        vertices = self.sprite_stream.staging(VERTEX, len(data))
+        vertices[:] = data
+        first = self.sprite_stream.write(vertices, sizeof(VERTEX))
 
-        gl.glDrawArrays(gl.GL_QUADS, 0, len(data))
+        gl.glDrawArrays(gl.GL_QUADS, first, len(vertices))
 
 
 
@@ -385,6 +680,8 @@ class SimulationView:
         self.framebuffer.resize(self.fbo_width, self.fbo_height)
         self.program.uniform2f(b'window_size', self.fbo_width, self.fbo_height)
         self.sprite_program.uniform2f(b'window_size', self.fbo_width, self.fbo_height)
+        if self.instancing:
+            self.instanced_program.uniform2f(b'window_size', self.fbo_width, self.fbo_height)
         self.screen_width = x
         self.screen_height = y
         self.scroll_to(x // 2, y // 2)
@@ -398,7 +695,7 @@ class SimulationView:
 
         if obj:
             logging.debug('clicked Object %s', getattr(obj, 'name', '?'))
-        else:
+        elif self.mouse_pos_world is not None:
             X = self.mouse_pos_world[0]
             Y = self.mouse_pos_world[1]
 
@@ -440,6 +737,9 @@ class SimulationView:
             self.speed += 0.5
         if symbol == key.NUM_SUBTRACT:
             self.speed = max(0.0, self.speed - 0.5)
+        if symbol == key.T and self.clock:
+            self.clock.turbo = not self.clock.turbo
+            logging.info('Turbo mode {}'.format('on' if self.clock.turbo else 'off'))
 
     def scroll(self, dx, dy):
         self.scroll_to(self.screen_origin_x + dx, self.screen_origin_y + dy)
@@ -447,6 +747,8 @@ class SimulationView:
     def scroll_to(self, x, y):
         self.program.uniform2f(b'screen_origin', x // self.pixel_size, -y // self.pixel_size)
         self.sprite_program.uniform2f(b'screen_origin', x // self.pixel_size, -y // self.pixel_size)
+        if self.instancing:
+            self.instanced_program.uniform2f(b'screen_origin', x // self.pixel_size, -y // self.pixel_size)
         self.screen_origin_x = x
         self.screen_origin_y = y
 
@@ -457,11 +759,47 @@ class SimulationView:
         X, Y, Z, mode, rank = self.mouse_pos_world
         if mode == ZMODE_SUBVOX_MIDDLE:
             # currently only persons
-            if len(self.pers[X, Y]) > rank:
-                return ('pers', self.pers[X, Y][rank])
+            store = self.simulation.guests
+            persons = sorted((store.views[slot] for slot in self.simulation.guest_tiles.at(X, Y)),
+                             key=lambda pers: pers.x + pers.y)
+            if len(persons) > rank:
+                return ('pers', persons[rank])
 
         elif mode in (ZMODE_CENTER, ZMODE_FRONT, ZMODE_BACK):
             if len(self.scenery[X, Y]) > rank:
                 return ('scen', self.scen[X, Y][rank])
 
         return (None, None)
+
+
+def test():
+    import gc
+
+    def assert_eq(a, b):
+        assert a == b, '%s != %s' % (a, b)
+
+    class Obj:
+        pass
+
+    mapper = Mapper(max_key=2)
+    a, b, c, d = Obj(), Obj(), Obj(), Obj()
+    assert_eq((mapper.key(a), mapper.key(b), mapper.key(a)), (1, 2, 1))
+    assert_eq(mapper.obj(2), b)
+
+    # all keys are in use, the refused object is counted once however often it asks
+    assert_eq((mapper.key(c), mapper.key(c)), (0, 0))
+    assert_eq((mapper.overflows, mapper.released), (1, 0))
+
+    # the key of a collected object is released and reused
+    del a
+    gc.collect()
+    assert_eq((len(mapper), mapper.free, mapper.released), (1, [1], 1))
+    assert_eq(mapper.obj(1), None)
+    assert_eq(mapper.key(c), 1)
+    assert_eq(mapper.obj(1), c)
+    assert_eq((mapper.key(d), mapper.overflows), (0, 2))
+    assert_eq(len(mapper.refused), 1)
+
+
+if __name__ == '__main__':
+    test()
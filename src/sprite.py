@@ -9,8 +9,9 @@ from textmanager import Rect
 import logging
 import graphix
 import os.path
+import numpy as np
 
-from simulationview import (VOXEL_HEIGHT, VOXEL_X_SIDE, VOXEL_Y_SIDE,
+from simulationview import (VOXEL_HEIGHT, VOXEL_X_SIDE,
                             zbuffer, ZMODE_CENTER, ZMODE_FRONT, ZMODE_BACK,
     VERTEX)
 
@@ -85,6 +86,28 @@ class Sprite:
             yield VERTEX((x + dx, y - dx, z + dz_up, zbuf), (r.right + u_offset, r.top, palette, 0), key)
             yield VERTEX((x + dx, y - dx, z + dz_down, zbuf), (r.right + u_offset, r.bottom, palette, 0), key)
 
+    def set_uniforms(self, program, time):
+        '''
+        Set the uniforms of the instanced sprite shader, see shaders.vertex_sprite_instanced.
+        The layer uniform is set per layer by the caller.
+        '''
+        program.uniform1f(b'time', time)
+        program.uniform1f(b'fps', self.fps if self.animated else 0.0)
+        program.uniform2f(b'frame_origin', self.frame_left_uv, self.frame_top_uv)
+        program.uniform2f(b'frame_size', self.frame_width_uv, self.frame_height_uv)
+        dz_up = self.offset_y / VOXEL_HEIGHT
+        program.uniform3f(b'sprite_offset', self.offset_x / VOXEL_X_SIDE * 0.5, dz_up, -self.frame_height / VOXEL_HEIGHT + dz_up)
+        program.uniform3f(b'directions', self.start_deg, self.turn_deg, self.directions)
+
+    def pose_frames(self, poses):
+        '''
+        Arrays of the first frame and of the number of frames for each pose name in poses.
+        Used to fill the instance data of the instanced sprite shader.
+        '''
+        first_frame = np.array([self.poses[pose].first_frame for pose in poses], np.float32)
+        number_of_frames = np.array([self.poses[pose].number_of_frames for pose in poses], np.float32)
+        return first_frame, number_of_frames
+
     def get_coordinates(self, time, pose, direction):
         ''' get texture coordinates for a quad as a Rect'''
         current_pose = self.poses[pose]
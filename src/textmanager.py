@@ -2,7 +2,10 @@ TEXT_HEIGHT = 16
 BUFFER_WIDTH = 512
 BUFFER_HEIGHT = 512
 
+import bisect
+
 import PIL.ImageFont, PIL.ImageDraw, PIL.Image
+import numpy as np
 
 FONTFILE = '/usr/share/fonts/truetype/freefont/FreeSansBold.ttf'
 
@@ -21,73 +24,187 @@ class Rect:
     def height(self):
         return self.bottom - self.top
 
-class Block:
-    def __init__(self, left, right):
-        self.left = left
-        self.right = right
+    def union(self, other):
+        ''' the smallest Rect containing this and other '''
+        return Rect(min(self.left, other.left), min(self.top, other.top),
+                    max(self.right, other.right), max(self.bottom, other.bottom))
 
-    @property
-    def width(self):
-        return self.right - self.left
+MAX_SIZE = 4096  # the image does not grow beyond this height
+REPACK_FILL = 0.5  # a full image is repacked if less than this fraction is in use, otherwise it grows
 
 class Allocation:
-    def __init__(self, rect, line):
+    def __init__(self, rect):
         self.refcount = 1
         self.rect = rect
-        self.line = line
+
+class Glyph:
+    def __init__(self, rect, advance):
+        self.rect = rect
+        self.advance = advance
 
 class TextManager:
+    '''
+    Manages the image holding the drawn texts of the labels.
+
+    The image is divided into shelves of line_height pixels. The free blocks
+    of all shelves are kept sorted by width, so the best fitting block is found
+    by bisection. A freed rect is merged with the free blocks next to it.
+
+    When no block fits, the image is repacked if it is mostly empty and
+    doubles its height otherwise. Both move the allocations: their rects are
+    changed in place and layout_version is incremented, so labels know that
+    their texture coordinates are outdated.
+    '''
     def __init__(self, width=512, height=512, line_height=20):
         self.font = PIL.ImageFont.truetype(FONTFILE, 16, encoding='unic')
         self.allocations = {}
         self.width = width
-        self.height = height
         self.line_height = line_height
-        self.img = PIL.Image.new('L', (width, height), color=0)
-        self.draw = PIL.ImageDraw.Draw(self.img)
+        # the pixels are the staging memory for texture uploads, texts are drawn
+        # into the one line scratch image and copied to their place
+        self.pixels = np.zeros((height, width), np.uint8)
+        self.scratch = PIL.Image.new('L', (width, line_height), color=0)
+        self.draw = PIL.ImageDraw.Draw(self.scratch)
         self.allocated = {}
-        self.freespace = []
-        self.dirty = False
-        print (len(self.img.tobytes()), 512 * 512)
+        self.glyphs = {}  # the Glyph of every character drawn, glyphs are never freed
+        self.used = 0  # the summed width of all allocated rects
+        self.layout_version = 0
+        self._reset(height)
+        self.dirty = None  # the Rect of the pixels changed since the last upload, None if there are none
+
+    def _reset(self, height):
+        ''' forget all allocations, the image has the given height '''
+        self.height = height
+        self.shelves = 0
+        self.free_blocks = []  # sorted (width, top, left) of all free blocks
+        self.block_right = {}  # the right edge of the free blocks by (top, left)
+        self.block_left = {}  # the left edge of the free blocks by (top, right)
 
     def dump(self):
-        self.img.save('textmanager.png')
-
-    def _allocate(self, text):
-        w, h = self.font.getsize(text)
+        PIL.Image.fromarray(self.pixels).save('textmanager.png')
+
+    def invalidate(self, rect):
+        ''' add rect to the dirty region '''
+        self.dirty = rect if self.dirty is None else self.dirty.union(rect)
+
+    def _add_block(self, top, left, right):
+        if right > left:
+            bisect.insort(self.free_blocks, (right - left, top, left))
+            self.block_right[top, left] = right
+            self.block_left[top, right] = left
+
+    def _remove_block(self, top, left, right):
+        del self.free_blocks[bisect.bisect_left(self.free_blocks, (right - left, top, left))]
+        del self.block_right[top, left]
+        del self.block_left[top, right]
+
+    def _fit(self, w):
+        ''' take a rect of width w from the best fitting free block or a new shelf, None if there is no space '''
+        i = bisect.bisect_left(self.free_blocks, (w,))
+        if i < len(self.free_blocks):
+            width, top, left = self.free_blocks[i]
+            self._remove_block(top, left, left + width)
+        elif (self.shelves + 1) * self.line_height <= self.height:
+            width, top, left = self.width, self.shelves * self.line_height, 0
+            self.shelves += 1
+        else:
+            return None
+        self._add_block(top, left + w, left + width)
+        return Rect(left, top, left + w, top + self.line_height)
+
+    def _allocate(self, w, h):
         if h > self.line_height:
             raise Exception('text too high')
         if w > self.width:
             raise Exception('text too wide')
 
-        for (i, line) in enumerate(self.freespace):
-            for block in line:
-                if block.width > w:
-                    rect = Rect(block.left, i * self.line_height, block.left + w, (i + 1) * self.line_height)
-                    block.left = rect.right
-                    self.allocated[text] = Allocation(rect, i)
-                    return rect
-
-        i = len(self.freespace)
-        if (i + 1) * self.line_height > self.height:
-            raise Exception('out of image space')
-        line = [Block(w, self.width)]
-        self.freespace.append(line)
-        rect = Rect(0, i * self.line_height, w, (i + 1) * self.line_height)
-        self.allocated[text] = Allocation(rect, i)
+        rect = self._fit(w)
+        if rect is None and self.used < REPACK_FILL * self.width * self.height / self.line_height:
+            self._relayout(self.height)
+            rect = self._fit(w)
+        while rect is None:
+            self._relayout(2 * self.height)
+            rect = self._fit(w)
+        self.used += w
         return rect
 
+    def _release(self, rect):
+        top, left, right = rect.top, rect.left, rect.right
+        if (top, left) in self.block_left:
+            left = self.block_left[top, left]
+            self._remove_block(top, left, rect.left)
+        if (top, right) in self.block_right:
+            right = self.block_right[top, right]
+            self._remove_block(top, rect.right, right)
+        self._add_block(top, left, right)
+        self.used -= rect.width
+
+    def _relayout(self, height):
+        '''
+        Pack all allocations anew into an image of the given height.
+
+        The allocations are placed widest first, if they do not fit the
+        height is doubled. If they do not fit into MAX_SIZE, the old layout
+        is kept and an exception is raised.
+        '''
+        live = [alloc.rect for alloc in self.allocated.values()] + [glyph.rect for glyph in self.glyphs.values()]
+        live.sort(key=lambda rect: rect.width, reverse=True)
+        old_layout = self.height, self.shelves, self.free_blocks, self.block_right, self.block_left
+        while True:
+            if height > MAX_SIZE:
+                self.height, self.shelves, self.free_blocks, self.block_right, self.block_left = old_layout
+                raise Exception('out of image space')
+            self._reset(height)
+            placed = []
+            for rect in live:
+                new = self._fit(rect.width)
+                if new is None:
+                    break
+                placed.append(new)
+            else:
+                break
+            height *= 2
+
+        pixels = np.zeros((height, self.width), np.uint8)
+        for rect, new in zip(live, placed):
+            pixels[new.top:new.bottom, new.left:new.right] = self.pixels[rect.top:rect.bottom, rect.left:rect.right]
+            rect.left, rect.top, rect.right, rect.bottom = new.left, new.top, new.right, new.bottom
+        self.pixels = pixels
+        self.dirty = Rect(0, 0, self.width, height)
+        self.layout_version += 1
+
+    def _render(self, text, rect):
+        self.draw.rectangle((0, 0, rect.width, rect.height), fill=0)
+        self.draw.text((0, 0), text, font=self.font, fill=255)
+        self.pixels[rect.top:rect.bottom, rect.left:rect.right] = \
+            np.asarray(self.scratch.crop((0, 0, rect.width, rect.height)))
+        self.invalidate(rect)
+
     def alloc(self, text):
         if text in self.allocated:
             self.allocated[text].refcount += 1
             return self.allocated[text].rect
 
-        self.dirty = True
-        rect = self._allocate(text)
-        self.draw.rectangle((rect.left, rect.top, rect.right, rect.bottom), fill=0)
-        self.draw.text((rect.left, rect.top), text, font=self.font, fill=255)
+        rect = self._allocate(*self.font.getsize(text))
+        self.allocated[text] = Allocation(rect)
+        self._render(text, rect)
         return rect
 
+    def glyph(self, char):
+        '''
+        The Glyph of a single character.
+
+        The character is drawn into the image the first time it is requested,
+        afterwards the cached Glyph is returned.
+        '''
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            w, h = self.font.getsize(char)
+            rect = self._allocate(w, h)
+            self._render(char, rect)
+            glyph = self.glyphs[char] = Glyph(rect, w)
+        return glyph
+
     def free(self, text):
         if text not in self.allocated:
             raise Exception('double free')
@@ -95,18 +212,5 @@ class TextManager:
         alloc = self.allocated[text]
         alloc.refcount -= 1
         if alloc.refcount <= 0:
-            line = self.freespace[alloc.line]
             del self.allocated[text]
-            for i, block in enumerate(line):
-                if block.right == alloc.rect.left:
-                    block.right = alloc.rect.right
-                    if i + 1 < len(line) and line[i + 1].left == block.right:
-                        block.right = line[i + 1].right
-                        del line[i + 1]
-                    return
-                if block.left == alloc.rect.right:
-                    block.left = alloc.rect.left
-                    return
-            line.append(Block(alloc.rect.left, alloc.rect.right))
-            line.sort(key=lambda block:block.left)
-
+            self._release(alloc.rect)
@@ -7,19 +7,37 @@ application window has coordinates (0,0).
 @author: Leonhard Vogt
 """
 import logging
-from ctypes import pointer, sizeof
-import ctypes
+from collections import defaultdict
+from ctypes import POINTER, pointer, sizeof
 
-from graphix import GlProgram
+import numpy as np
+
+from graphix import GlProgram, VertexArray
 import shaders
 
 from pyglet import gl
 import pyglet.window.mouse
 from textmanager import TextManager
 
+def _geometry(name):
+    '''a property of the window geometry, setting it marks the window for update'''
+    attribute = '_' + name
+
+    def set_value(self, value):
+        setattr(self, attribute, value)
+        self.invalidate()
+
+    return property(lambda self: getattr(self, attribute), set_value)
+
+
 class Window:
     '''
     The window class is the base class for all windows and controls.
+
+    The vertices of every window are kept in a slot of the vertex buffer of
+    the WindowManager. Changing the geometry of a window marks it and its
+    descendants for update, subclasses call invalidate() when anything else
+    changes the output of own_data.
     '''
     def __init__(self, parent, left, top, width, height):
         '''
@@ -31,16 +49,23 @@ class Window:
         width -- the width of the window.
         height -- the height of the window.
         '''
+        self.children = []
+        self.parent = parent
+        self.manager = parent.manager if parent else None
+        self.slot = None  # the first vertex and the number of vertices in the vertex buffer
+        self.closed = False
         self.left = left
         self.top = top
         self.width = width
         self.height = height
-        self.children = []
-        self.parent = parent
         if parent:
-            self.manager = parent.manager
             self.parent.add(self)
 
+    left = _geometry('left')
+    top = _geometry('top')
+    width = _geometry('width')
+    height = _geometry('height')
+
     @property
     def right(self):
         ''' the x-position of the right edge of the window (exclusive) '''
@@ -51,6 +76,27 @@ class Window:
         ''' the y-position of the bottom edge of the window (exclusive) '''
         return self.top + self.height
 
+    def origin(self):
+        ''' the position of the top left corner of the window in window manager coordinates '''
+        x, y = 0, 0
+        window = self
+        while window:
+            x += window.left
+            y += window.top
+            window = window.parent
+        return x, y
+
+    def invalidate(self):
+        '''
+        Mark this window and its descendants for an update of their vertices.
+        Closed windows are not updated any more.
+        '''
+        if self.manager is None or self.closed:
+            return
+        self.manager.dirty.add(self)
+        for child in self.children:
+            child.invalidate()
+
     def own_data(self, x, y):
         '''
         Iterate over all the vertex data needed for rendering this window.
@@ -62,20 +108,6 @@ class Window:
         yield from (x + self.width, y + self.height, 1.0, 0.0)
         yield from (x + self.width, y, 1.0, 0.0)
 
-    def get_data(self, x, y):
-        '''
-        Iterate over vertex data for this and all child windows
-        '''
-        x += self.left
-        y += self.top
-
-        if self.parent:
-            # this excludes the invisible root window
-            yield from self.own_data(x, y)
-
-        for child in self.children:
-            yield from child.get_data(x, y)
-
     def add(self, child):
         '''
         Add a child window. The child should be a Window object.
@@ -83,21 +115,25 @@ class Window:
         if child in self.children:
             raise Exception('child already registered')
         self.children.append(child)
+        self.manager.order_dirty = True
 
     def remove(self, child):
         '''
         Remove a child window.
         '''
         self.children.remove(child)
+        self.manager.order_dirty = True
 
     def close(self):
         '''
         Close this window and unregister it from its parent. 
         '''
+        self.closed = True
         if self.parent:
             self.parent.remove(self)
-        for child in self.children:
+        for child in list(self.children):
             child.close()
+        self.manager.release(self)
 
     def on_click(self):
         '''
@@ -126,8 +162,13 @@ class Window:
 class Label(Window):
     '''
     The label window is used for showing text. When text is set its size changes to fit.
+
+    A label either shows its whole text as one image in the texture of the TextManager,
+    or, with glyphs=True, as a row of single character quads. Glyph labels
+    are suited for texts that change often, as after the characters have been
+    drawn once changing the text neither draws nor uploads anything.
     '''
-    def __init__(self, parent, text, left, top):
+    def __init__(self, parent, text, left, top, glyphs=False):
         '''
         Initialize the label window.
         
@@ -135,8 +176,10 @@ class Label(Window):
         text -- the text contents shown by the label
         left -- the x-position of the left edge of the window with respect to the parent.
         top -- the y-position of the top edge of the window.
+        glyphs -- compose the text from single character glyphs
         '''
         Window.__init__(self, parent, left, top, 0, 0)
+        self.glyphs = glyphs
         self._text = None
         self.text = text
 
@@ -150,24 +193,52 @@ class Label(Window):
         if self._text == text:
             return
         tm = self.manager.textmanager
-        if self._text is not None:
-            tm.free(self._text)
-        self._text = text
-
-        rect = self.manager.textmanager.alloc(text)
-        self.width = rect.width
-        self.height = rect.height
-        self.u0 = rect.left / tm.width
-        self.u1 = rect.right / tm.width
-        self.v0 = rect.top / tm.height
-        self.v1 = rect.bottom / tm.height
+        if self.glyphs:
+            self._text = text
+            self.row = []  # (offset, Glyph) of every character
+            offset = 0
+            for char in text:
+                glyph = tm.glyph(char)
+                self.row.append((offset, glyph))
+                offset += glyph.advance
+            self.width = offset
+            self.height = tm.line_height
+        else:
+            if self._text is not None:
+                tm.free(self._text)
+            self._text = text
+            self.rect = tm.alloc(text)
+            self.width = self.rect.width
+            self.height = self.rect.height
+        self.update_layout()
+        self.invalidate()
+
+    def update_layout(self):
+        '''
+        Compute the texture coordinates from the rects in the TextManager.
+
+        The TextManager moves the rects when it repacks or grows its image.
+        '''
+        tm = self.manager.textmanager
+        self.layout_version = tm.layout_version
+        if self.glyphs:
+            # a quad is (offset, width, u0, v0, u1, v1)
+            self.quads = [(offset, glyph.rect.width,
+                           glyph.rect.left / tm.width, glyph.rect.top / tm.height,
+                           glyph.rect.right / tm.width, glyph.rect.bottom / tm.height)
+                          for offset, glyph in self.row]
+        else:
+            self.u0 = self.rect.left / tm.width
+            self.u1 = self.rect.right / tm.width
+            self.v0 = self.rect.top / tm.height
+            self.v1 = self.rect.bottom / tm.height
 
     def close(self):
         '''
         Close this window and unregister it from its parent.
         Releases the text resource. 
         '''
-        if self._text:
+        if self._text and not self.glyphs:
             self.manager.textmanager.free(self._text)
         Window.close(self)
 
@@ -177,6 +248,15 @@ class Label(Window):
         
         A flat iterable of floats that are passed in the vertex buffer.
         '''
+        if self.layout_version != self.manager.textmanager.layout_version:
+            self.update_layout()
+        if self.glyphs:
+            bottom = y + self.height
+            for offset, width, u0, v0, u1, v1 in self.quads:
+                left = x + offset
+                yield from (left, y, u0, v0, left, bottom, u0, v1,
+                            left + width, bottom, u1, v1, left + width, y, u1, v0)
+            return
         yield from (x, y, self.u0, self.v0)
         yield from (x, y + self.height, self.u0, self.v1)
         yield from (x + self.width, y + self.height, self.u1, self.v1)
@@ -191,10 +271,23 @@ class WindowManager():
     It uses a TextManager object to manage the texture resources used by the Label objects.
     
     The window manager creates an invisible root window which is the ancestor to all windows managed.  
+
+    The vertices of the windows are retained in a vertex buffer. Every window
+    owns a slot of a power of two number of quads, the unused part of a slot
+    holds empty quads. Only the vertices of windows marked dirty are
+    recomputed and uploaded, and the list of slots in drawing order is only
+    rebuilt when windows are added, removed or change slots.
     '''
     def __init__(self):
         '''initialize the WindowManager'''
         self.textmanager = TextManager()
+        self.vertices = np.zeros((256, 4), np.float32)  # CPU copy of the vertex buffer
+        self.vertex_count = 0  # vertices up to here are used by slots
+        self.free_slots = defaultdict(list)  # the first vertex of free slots by slot size
+        self.dirty = set()  # windows whose vertices have to be updated
+        self.upload_range = None  # (start, stop) of the vertices to upload
+        self.order_dirty = True
+        self.layout_version = self.textmanager.layout_version
         self.root = Window(None, 0, 0, 1, 1)
         self.root.manager = self
         self.init_gl()
@@ -203,12 +296,16 @@ class WindowManager():
         '''initialize the opengl resources needed for presenting windows
         
         * a shader program
-        * a vertex buffer
+        * a vertex buffer and the vertex array sourcing it
         * a texture for Label windows
         '''
         self.program = GlProgram(shaders.vertex_flat, shaders.fragment_flat)
         self.buffer = gl.GLuint(0)
         gl.glGenBuffers(1, pointer(self.buffer))
+        self.buffer_size = 0  # the number of vertices allocated in the vertex buffer
+        self.vertex_array = VertexArray()
+        with self.vertex_array:
+            self.program.vertex_attrib_pointer(self.buffer, b"position", 4)
         self.texture = gl.GLuint(0)
         gl.glGenTextures(1, pointer(self.texture))
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
@@ -216,39 +313,141 @@ class WindowManager():
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
+        self.allocate_text_texture()
         gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
 
+    def allocate_text_texture(self):
+        '''allocate the bound texture in the size of the TextManager image and upload all of it'''
+        tm = self.textmanager
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D,
+                     0,  # level
+                     gl.GL_R8,
+                     tm.width,
+                     tm.height,
+                     0,
+                     gl.GL_RED,
+                     gl.GL_UNSIGNED_BYTE,
+                     tm.pixels.ctypes.data)
+        self.texture_size = tm.width, tm.height
+        tm.dirty = None
+
+    def upload_text(self, rect):
+        '''copy rect of the TextManager pixels into the bound texture'''
+        pixels = self.textmanager.pixels
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, pixels.shape[1])
+        gl.glTexSubImage2D(gl.GL_TEXTURE_2D,
+                     0,  # level
+                     rect.left,
+                     rect.top,
+                     rect.width,
+                     rect.height,
+                     gl.GL_RED,
+                     gl.GL_UNSIGNED_BYTE,
+                     pixels[rect.top:, rect.left:].ctypes.data)
+        gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, 0)
+
+    def alloc_slot(self, count):
+        '''allocate a slot for at least count vertices and return (first, size)'''
+        size = 4
+        while size < count:
+            size *= 2
+        if self.free_slots[size]:
+            return self.free_slots[size].pop(), size
+        first = self.vertex_count
+        self.vertex_count += size
+        if self.vertex_count > len(self.vertices):
+            vertices = np.zeros((2 * self.vertex_count, 4), self.vertices.dtype)
+            vertices[:len(self.vertices)] = self.vertices
+            self.vertices = vertices
+        return first, size
+
+    def release(self, window):
+        '''free the slot of a closed window'''
+        self.dirty.discard(window)
+        if window.slot is not None:
+            first, size = window.slot
+            self.free_slots[size].append(first)
+            window.slot = None
+        self.order_dirty = True
+
+    def mark_upload(self, start, stop):
+        '''add the vertices from start to stop to the range uploaded in the next draw'''
+        if self.upload_range is None:
+            self.upload_range = start, stop
+        else:
+            self.upload_range = min(self.upload_range[0], start), max(self.upload_range[1], stop)
+
+    def update(self, window):
+        '''write the vertices of window into its slot'''
+        data = np.fromiter(window.own_data(*window.origin()), np.float32).reshape(-1, 4)
+        if window.slot is None or window.slot[1] < len(data):
+            if window.slot is not None:
+                self.free_slots[window.slot[1]].append(window.slot[0])
+            window.slot = self.alloc_slot(len(data))
+            self.order_dirty = True
+        first, size = window.slot
+        self.vertices[first:first + len(data)] = data
+        self.vertices[first + len(data):first + size] = 0
+        self.mark_upload(first, first + size)
+
+    def update_order(self):
+        '''collect the slots of all windows in drawing order, parents before their children'''
+        first, count = [], []
+        stack = list(reversed(self.root.children))
+        while stack:
+            window = stack.pop()
+            if window.slot is not None:
+                first.append(window.slot[0])
+                count.append(window.slot[1])
+            stack.extend(reversed(window.children))
+        self.draw_first = np.array(first, np.int32)
+        self.draw_count = np.array(count, np.int32)
+        self.order_dirty = False
+
     def draw(self):
         '''
         Draw the windows.
         '''
         self.program.use()
 
-        data = list(self.root.get_data(0, 0))
-        data = (gl.GLfloat * len(data))(*data)
+        if self.layout_version != self.textmanager.layout_version:
+            # the TextManager has moved the texts, the texture coordinates of all labels change
+            self.layout_version = self.textmanager.layout_version
+            self.root.invalidate()
+        if self.dirty:
+            for window in self.dirty:
+                if window.parent:
+                    self.update(window)
+            self.dirty.clear()
+        if self.order_dirty:
+            self.update_order()
 
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer)
-        gl.glBufferData(gl.GL_ARRAY_BUFFER, sizeof(data), data, gl.GL_DYNAMIC_DRAW)
+        if self.buffer_size != len(self.vertices):
+            self.buffer_size = len(self.vertices)
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, self.vertices.nbytes, self.vertices.ctypes.data, gl.GL_DYNAMIC_DRAW)
+        elif self.upload_range is not None:
+            start, stop = self.upload_range
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER, start * 4 * sizeof(gl.GLfloat),
+                               (stop - start) * 4 * sizeof(gl.GLfloat), self.vertices[start:].ctypes.data)
+        self.upload_range = None
 
         gl.glActiveTexture(gl.GL_TEXTURE0)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
-        if self.textmanager.dirty:
-            # only upload the texture to the GPU if it has actually changed
-            gl.glTexImage2D(gl.GL_TEXTURE_2D,
-                     0,  # level
-                     gl.GL_R8,
-                     self.textmanager.width,
-                     self.textmanager.height,
-                     0,
-                     gl.GL_RED,
-                     gl.GL_UNSIGNED_BYTE,
-                     ctypes.create_string_buffer(self.textmanager.img.tobytes()))
-            self.textmanager.dirty = False
+        if self.texture_size != (self.textmanager.width, self.textmanager.height):
+            # the TextManager image has grown
+            self.allocate_text_texture()
+        elif self.textmanager.dirty is not None:
+            # only upload the part of the texture that has actually changed
+            self.upload_text(self.textmanager.dirty)
+            self.textmanager.dirty = None
         self.program.uniform1i(b"tex", 0)  # set to 0 because the texture is bound to GL_TEXTURE0
 
-        self.program.vertex_attrib_pointer(self.buffer, b"position", 4)
-        # self.program.vertex_attrib_pointer(self.buffer, b"texcoord", 2, stride=4 * sizeof(gl.GLfloat), offset=2 * sizeof(gl.GLfloat))
-        gl.glDrawArrays(gl.GL_QUADS, 0, len(data) // 4)
+        self.vertex_array.bind()
+        gl.glMultiDrawArrays(gl.GL_QUADS, self.draw_first.ctypes.data_as(POINTER(gl.GLint)),
+                             self.draw_count.ctypes.data_as(POINTER(gl.GLsizei)), len(self.draw_first))
 
     def on_mouse_press(self, x, y, button, modifiers):
         '''forward the event to the root window'''